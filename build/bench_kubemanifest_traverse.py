@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Compares the KubeManifest fix_types and traverse_modify path transforms
+against the recursive implementation they replaced, on a generated
+multi-megabyte CRD.
+
+The current functions are read straight from functions/source/KubeManifest,
+so the Lambda's dependencies don't need to be installed.
+"""
+
+import argparse
+import ast
+import copy
+import json
+import re
+import tracemalloc
+from functools import lru_cache
+from pathlib import Path
+from time import perf_counter
+
+KUBE_MANIFEST = (
+    Path(__file__).resolve().parents[1] / "functions/source/KubeManifest/index.py"
+)
+FUNCTIONS = {
+    "_keys",
+    "traverse",
+    "traverse_modify",
+    "traverse_modify_all",
+    "_compile_path",
+    "compile_path",
+    "to_path",
+    "set_type",
+    "fix_types",
+}
+CONSTANTS = {"INDEX_PATTERN"}
+
+
+# Implementation before the iterative walk, kept verbatim as the baseline
+def old_traverse(obj, path=None, callback=None):
+    if path is None:
+        path = []
+
+    if isinstance(obj, dict):
+        value = {k: old_traverse(v, path + [k], callback) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        value = [
+            old_traverse(obj[idx], path + [[idx]], callback) for idx in range(len(obj))
+        ]
+    else:
+        value = obj
+
+    if callback is None:
+        return value
+    else:
+        return callback(path, value)
+
+
+def old_traverse_modify(obj, target_path, action):
+    target_path = old_to_path(target_path)
+
+    def transformer(path, value):
+        if path == target_path:
+            return action(value)
+        else:
+            return value
+
+    return old_traverse(obj, callback=transformer)
+
+
+def old_traverse_modify_all(obj, action):
+    def transformer(_, value):
+        return action(value)
+
+    return old_traverse(obj, callback=transformer)
+
+
+def old_to_path(path):
+    if isinstance(path, list):
+        return path  # already in list format
+
+    def _iter_path(inner_path):
+        indexes = [[int(i[1:-1])] for i in re.findall(r"\[[0-9]+\]", inner_path)]
+        lists = re.split(r"\[[0-9]+\]", inner_path)
+
+        for parts in range(len(lists)):
+            for part in lists[parts].strip(".").split("."):
+                yield part
+
+            if parts < len(indexes):
+                yield indexes[parts]
+            else:
+                yield []
+
+    return list(_iter_path(path))[:-1]
+
+
+def old_fix_types(manifest, set_type):
+    return old_traverse_modify_all(manifest, set_type)
+
+
+def load_current():
+    """Executes only the path transform definitions from KubeManifest."""
+    tree = ast.parse(KUBE_MANIFEST.read_text())
+    body = []
+
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in FUNCTIONS:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(
+            getattr(t, "id", None) in CONSTANTS for t in node.targets
+        ):
+            body.append(node)
+
+    namespace = {"re": re, "lru_cache": lru_cache}
+    exec(
+        compile(ast.Module(body=body, type_ignores=[]), str(KUBE_MANIFEST), "exec"),
+        namespace,
+    )  # nosec B102
+
+    missing = FUNCTIONS - namespace.keys()
+    if missing:
+        raise SystemExit(
+            f"{KUBE_MANIFEST} no longer defines {', '.join(sorted(missing))}"
+        )
+
+    return namespace
+
+
+def schema(depth, width):
+    """A nested OpenAPI schema like the ones CRDs embed."""
+    if depth == 0:
+        return {
+            "type": "string",
+            "description": "A leaf field. " * 8,
+            "default": "true",
+            "maxLength": "253",
+            "enum": ["false", "42", "value"],
+        }
+
+    return {
+        "type": "object",
+        "description": "An object field. " * 4,
+        "required": [f"field{i}" for i in range(0, width, 2)],
+        "properties": {f"field{i}": schema(depth - 1, width) for i in range(width)},
+        "x-kubernetes-preserve-unknown-fields": "false",
+    }
+
+
+def crd(megabytes):
+    versions = []
+    manifest = {
+        "apiVersion": "apiextensions.k8s.io/v1",
+        "kind": "CustomResourceDefinition",
+        "metadata": {"name": "widgets.example.com"},
+        "spec": {
+            "group": "example.com",
+            "names": {"kind": "Widget", "plural": "widgets"},
+            "scope": "Namespaced",
+            "versions": versions,
+        },
+    }
+
+    while len(json.dumps(manifest)) < megabytes * 1024 * 1024:
+        versions.append(
+            {
+                "name": f"v{len(versions) + 1}",
+                "served": "true",
+                "storage": "false",
+                "schema": {"openAPIV3Schema": schema(4, 6)},
+            }
+        )
+
+    return manifest
+
+
+def measure(func, manifest, repeat):
+    """Best time and peak allocation of func over fresh copies of manifest."""
+    best = float("inf")
+    peak = 0
+
+    for _ in range(repeat):
+        data = copy.deepcopy(manifest)
+        tracemalloc.start()
+        start = perf_counter()
+        result = func(data)
+        best = min(best, perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--megabytes", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--modifies", type=int, default=10, help="traverse_modify calls per run"
+    )
+    args = parser.parse_args()
+
+    current = load_current()
+    manifest = crd(args.megabytes)
+    size = len(json.dumps(manifest)) / 1024 / 1024
+    target = "spec.versions[0].schema.openAPIV3Schema.properties.field0.description"
+
+    def modify(traverse_modify):
+        def run(data):
+            for _ in range(args.modifies):
+                data = traverse_modify(data, target, str.upper)
+            return data
+
+        return run
+
+    cases = [
+        (
+            "fix_types",
+            lambda data: old_fix_types(data, current["set_type"]),
+            current["fix_types"],
+        ),
+        (
+            f"{args.modifies}x traverse_modify",
+            modify(old_traverse_modify),
+            modify(current["traverse_modify"]),
+        ),
+    ]
+
+    print(f"CRD of {size:.1f} MB, best of {args.repeat}")
+    for name, old, new in cases:
+        old_time, old_peak, old_result = measure(old, manifest, args.repeat)
+        new_time, new_peak, new_result = measure(new, manifest, args.repeat)
+
+        if old_result != new_result:
+            raise SystemExit(f"{name}: results differ")
+
+        print(
+            f"{name:>24}: {old_time * 1000:9.1f} ms {old_peak / 1024 / 1024:6.1f} MB peak"
+            f"  ->  {new_time * 1000:9.1f} ms {new_peak / 1024 / 1024:6.1f} MB peak"
+        )
+
+
+if __name__ == "__main__":
+    main()
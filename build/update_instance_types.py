@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import json
+import logging
 import re
 from pathlib import Path
+import sys
 from sys import argv
 import boto3
 import requests
@@ -10,6 +12,9 @@ import yaml
 from cfnlint.decode import cfn_yaml
 from cfn_flip import load_yaml, get_dumper
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'functions/source/QuickStartUtilsLayer'))
+from quickstart_utils.profiler import profile  # noqa: E402
+
 TASKCAT_GLOBAL_CONFIG = Path('~/.taskcat.yml').expanduser().resolve()
 TASKCAT_PROJECT_CONFIG = Path('./.taskcat.yml').resolve()
 INSTANCE_INFO = 'https://ec2instances.info/instances.json'
@@ -128,14 +133,7 @@ def eval_filter(ec2_filter, instances):
     return matched_instances
 
 
-if __name__ == '__main__':
-    if not len(argv) == 2:
-        print("Usage: update_instance_types.py <TEMPLATE_PATH>")
-        exit(1)
-    template_path = Path(argv[1]).expanduser().resolve()
-    if not template_path.is_file():
-        print(f"Cannot find template at {template_path}")
-        exit(1)
+def main(template_path):
     template = cfn_yaml.load(str(template_path))
     config = template.get('Metadata', {}).get('AutoInstance')
     if not config:
@@ -173,3 +171,19 @@ if __name__ == '__main__':
             template = template_rewriter(snippet, rules, template)
         with open(template_path, 'w') as fh:
             fh.write(template.start_mark.buffer[:-1])
+
+
+if __name__ == '__main__':
+    if len(argv) not in (2, 3):
+        print("Usage: update_instance_types.py <TEMPLATE_PATH> [PROFILE_DESTINATION]")
+        exit(1)
+    template_path = Path(argv[1]).expanduser().resolve()
+    if not template_path.is_file():
+        print(f"Cannot find template at {template_path}")
+        exit(1)
+    if len(argv) == 3:
+        logging.basicConfig(level=logging.INFO)
+        with profile('update_instance_types', argv[2]):
+            main(template_path)
+    else:
+        main(template_path)
@@ -1,18 +1,71 @@
 import boto3
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # Provided through CrhelperLayer in amazon-eks-per-region-resources.template.yaml
 from crhelper import CfnResource
 
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.metrics import Metrics
+from quickstart_utils.retry import Backoff, set_deadline
+from quickstart_utils.teardown import lambda_function
+
 logger = logging.getLogger(__name__)
 helper = CfnResource(json_logging=True, log_level="DEBUG")
+metrics = Metrics("CleanupLambdas")
 lambda_client = boto3.client("lambda")
+ec2 = boto3.client("ec2")
 
+MAX_WORKERS = 8
+DESCRIBE_BATCH = 200  # filter values allowed per describe call
+# Seconds the named functions' ENIs get to go before scanning for functions
+# that share them
+ENI_GRACE = 60
 
-@helper.delete
-def delete_handler(event, _):
-    security_group_id = event["ResourceProperties"]["SecurityGroupId"]
+
+def lambda_enis(security_group_id):
+    filters = [
+        {"Name": "group-id", "Values": [security_group_id]},
+        {"Name": "description", "Values": ["AWS Lambda VPC ENI-*"]},
+    ]
+    enis = []
+
+    for page in ec2.get_paginator("describe_network_interfaces").paginate(
+        Filters=filters
+    ):
+        enis += page["NetworkInterfaces"]
+
+    return enis
+
+
+def uses_security_group(function_name, security_group_id):
+    # ENI descriptions can outlive the function they name, or name another
+    # function than the one that now shares the ENI
+    try:
+        config = lambda_client.get_function_configuration(FunctionName=function_name)
+    except lambda_client.exceptions.ResourceNotFoundException:
+        return False
+
+    vpc_config = config.get("VpcConfig", {})
+    return security_group_id in vpc_config.get("SecurityGroupIds", [])
+
+
+def find_functions(security_group_id, enis):
+    """Finds the functions using the security group from their ENIs,
+    instead of listing every function in the region."""
+    names = set()
+
+    for eni in enis:
+        name = lambda_function(eni.get("Description", ""))
+        if name:
+            names.add(name)
+
+    return [n for n in sorted(names) if uses_security_group(n, security_group_id)]
+
+
+def scan_functions(security_group_id):
+    functions = []
     paginator = lambda_client.get_paginator("list_functions")
 
     for page in paginator.paginate():
@@ -21,15 +74,107 @@ def delete_handler(event, _):
             security_group_ids = vpc_config.get("SecurityGroupIds", [])
 
             if security_group_id in security_group_ids:
-                logger.info(f"deleting {function['FunctionName']}")
+                functions.append(function["FunctionName"])
+
+    return functions
+
+
+def delete_function(function_name):
+    logger.info(f"deleting {function_name}")
+
+    try:
+        lambda_client.delete_function(FunctionName=function_name)
+    except lambda_client.exceptions.ResourceNotFoundException:
+        logger.info(f"{function_name} already deleted")
+
+
+def delete_functions(function_names):
+    if not function_names:
+        return
+
+    with metrics.phase("lambda_delete"):
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(delete_function, n) for n in function_names]
+            for future in futures:
+                future.result()
+
+
+def wait_released(eni_ids, backoff):
+    """Waits until the given ENIs are gone and returns those still left
+    once the backoff runs out."""
+    pending = sorted(eni_ids)
+
+    while pending:
+        found = []
+        for pos in range(0, len(pending), DESCRIBE_BATCH):
+            filters = [
+                {
+                    "Name": "network-interface-id",
+                    "Values": pending[pos : pos + DESCRIBE_BATCH],
+                }
+            ]
+            response = ec2.describe_network_interfaces(Filters=filters)
+            found += [e["NetworkInterfaceId"] for e in response["NetworkInterfaces"]]
+
+        pending = sorted(found)
+        if pending:
+            logger.info(f"Waiting for {', '.join(pending)} to be released")
+            if not backoff.wait():
+                break
+
+    return pending
+
+
+@helper.delete
+def delete_handler(event, _):
+    props = event["ResourceProperties"]
+    security_group_id = props["SecurityGroupId"]
+
+    with metrics.phase("lambda_discover"):
+        enis = lambda_enis(security_group_id)
+        function_names = find_functions(security_group_id, enis)
+
+        if not enis:
+            # Functions left inactive have had their ENIs reclaimed, so only
+            # a scan finds them
+            function_names = scan_functions(security_group_id)
+
+    delete_functions(function_names)
+
+    if not enis:
+        return
+
+    with metrics.phase("eni_wait"):
+        # Hyperplane ENIs are shared by functions with the same subnets and
+        # security groups, so one can stay in use by a function its
+        # description doesn't name. Scan for those whenever one is left.
+        wait_for = [e["NetworkInterfaceId"] for e in enis]
+        left = wait_released(wait_for, Backoff(timeout=ENI_GRACE, base=5, cap=30))
+
+        if left:
+            logger.info(f"{', '.join(left)} still in use, scanning functions")
+            delete_functions(
+                [
+                    n
+                    for n in scan_functions(security_group_id)
+                    if n not in function_names
+                ]
+            )
+
+        # CloudFormation passes every resource property through as a string
+        if left and str(props.get("WaitForEniRelease", False)).lower() == "true":
+            left = wait_released(left, Backoff(base=5, cap=30))
 
-                lambda_client.delete_function(FunctionName=function["FunctionName"])
+        if left:
+            logger.warning(f"{', '.join(left)} not released in time")
 
 
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    metrics.set_dimensions(RequestType=event.get("RequestType", ""))
 
     logger.debug(json.dumps(event))
 
+    set_deadline(context)
     helper(event, context)
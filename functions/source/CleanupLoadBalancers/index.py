@@ -8,103 +8,240 @@
 import boto3
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # Provided through CrhelperLayer in amazon-eks-per-region-resources.template.yaml
 from crhelper import CfnResource
-from time import sleep
+
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.metrics import Metrics
+from quickstart_utils.retry import Backoff, set_deadline
+from quickstart_utils.teardown import eni_description, tagged_load_balancers
 
 logger = logging.getLogger(__name__)
 helper = CfnResource(json_logging=True, log_level="DEBUG")
+metrics = Metrics("CleanupLoadBalancers")
+
+MAX_WORKERS = 8
+DESCRIBE_BATCH = 200
+# Load balancer ENIs usually go within a minute or two of the delete
+ENI_RELEASE_TIMEOUT = 300
+SG_DELETE_ATTEMPTS = 10
 
 
 def delete_dependencies(sg_id, c):
-    filters = [{"Name": "ip-permission.group-id", "Values": [sg_id]}]
-
-    for sg in c.describe_security_groups(Filters=filters)["SecurityGroups"]:
-        for p in sg["IpPermissions"]:
-            if "UserIdGroupPairs" in p.keys():
-                if sg_id in [x["GroupId"] for x in p["UserIdGroupPairs"]]:
-                    try:
-                        c.revoke_security_group_ingress(
-                            GroupId=sg["GroupId"], IpPermissions=[p]
-                        )
-                    except Exception:
-                        logger.exception("ERROR: %s" % (sg["GroupId"]))
-
-    filters = [{"Name": "egress.ip-permission.group-id", "Values": [sg_id]}]
-
-    for sg in c.describe_security_groups(Filters=filters)["SecurityGroups"]:
-        for p in sg["IpPermissionsEgress"]:
-            if "UserIdGroupPairs" in p.keys():
-                if sg_id in [x["GroupId"] for x in p["UserIdGroupPairs"]]:
-                    try:
-                        c.revoke_security_group_egress(
-                            GroupId=sg["GroupId"], IpPermissions=[p]
-                        )
-                    except Exception:
-                        logger.exception("ERROR: %s" % (sg["GroupId"]))
-
-    filters = [{"Name": "group-id", "Values": [sg_id]}]
-    for eni in c.describe_network_interfaces(Filters=filters)["NetworkInterfaces"]:
-        try:
-            c.delete_network_interface(NetworkInterfaceId=eni["NetworkInterfaceId"])
-        except Exception:
-            logger.exception("ERROR: %s" % (eni["NetworkInterfaceId"]))
+    with metrics.phase("revoke"):
+        filters = [{"Name": "ip-permission.group-id", "Values": [sg_id]}]
+
+        for sg in c.describe_security_groups(Filters=filters)["SecurityGroups"]:
+            for p in sg["IpPermissions"]:
+                if "UserIdGroupPairs" in p.keys():
+                    if sg_id in [x["GroupId"] for x in p["UserIdGroupPairs"]]:
+                        try:
+                            c.revoke_security_group_ingress(
+                                GroupId=sg["GroupId"], IpPermissions=[p]
+                            )
+                        except Exception:
+                            logger.exception("ERROR: %s" % (sg["GroupId"]))
+
+        filters = [{"Name": "egress.ip-permission.group-id", "Values": [sg_id]}]
+
+        for sg in c.describe_security_groups(Filters=filters)["SecurityGroups"]:
+            for p in sg["IpPermissionsEgress"]:
+                if "UserIdGroupPairs" in p.keys():
+                    if sg_id in [x["GroupId"] for x in p["UserIdGroupPairs"]]:
+                        try:
+                            c.revoke_security_group_egress(
+                                GroupId=sg["GroupId"], IpPermissions=[p]
+                            )
+                        except Exception:
+                            logger.exception("ERROR: %s" % (sg["GroupId"]))
+
+    with metrics.phase("eni_delete"):
+        filters = [{"Name": "group-id", "Values": [sg_id]}]
+        for eni in c.describe_network_interfaces(Filters=filters)["NetworkInterfaces"]:
+            try:
+                c.delete_network_interface(NetworkInterfaceId=eni["NetworkInterfaceId"])
+            except Exception:
+                logger.exception("ERROR: %s" % (eni["NetworkInterfaceId"]))
+
+
+LB_TYPES = [
+    [
+        "elb",
+        "LoadBalancerName",
+        "LoadBalancerNames",
+        "LoadBalancerDescriptions",
+        "LoadBalancerName",
+    ],
+    ["elbv2", "LoadBalancerArn", "ResourceArns", "LoadBalancers", "ResourceArn"],
+]
+
+
+def discover_load_balancers(cluster_name):
+    """Returns the cluster's load balancers keyed by client, or None when
+    the tag lookup fails and the caller should scan."""
+    try:
+        return tagged_load_balancers(
+            boto3.client("resourcegroupstaggingapi"), cluster_name
+        )
+    except Exception:
+        logger.exception("Tag lookup failed, scanning load balancers instead")
+        return None
+
+
+def scan_load_balancers(elb, lt, cluster_name):
+    tag_key = "kubernetes.io/cluster/%s" % cluster_name
+    lbs = []
+    response = elb.describe_load_balancers()
+
+    while True:
+        lbs += [l[lt[1]] for l in response[lt[3]]]
+        if "NextMarker" in response.keys():
+            response = elb.describe_load_balancers(Marker=response["NextMarker"])
+        else:
+            break
+
+    lbs_to_remove = []
+    if lbs:
+        # Split LB list into groups of 'size' items.
+        size = 20
+        lb_groups = (lbs[pos : pos + size] for pos in range(0, len(lbs), size))
+        for lb_group in lb_groups:
+            lb_group = elb.describe_tags(**{lt[2]: lb_group})["TagDescriptions"]
+            for tags in lb_group:
+                for tag in tags["Tags"]:
+                    if tag["Key"] == tag_key and tag["Value"] == "owned":
+                        lbs_to_remove.append(tags[lt[4]])
+                    if (
+                        tag["Key"] == "elbv2.k8s.aws/cluster"
+                        and tag["Value"] == cluster_name
+                    ):
+                        lbs_to_remove.append(tags[lt[4]])
+
+    return lbs_to_remove
+
+
+def delete_load_balancer(elb, lt, lb):
+    logger.info("removing elb %s" % lb)
+    try:
+        elb.delete_load_balancer(**{lt[1]: lb})
+    except elb.exceptions.ClientError as e:
+        # The tagging API can still list a load balancer for a
+        # short while after it has been deleted
+        if e.response["Error"]["Code"] != "LoadBalancerNotFound":
+            raise
+        logger.info("elb %s already deleted" % lb)
+
+
+def delete_load_balancers(elb, lt, cluster_name, tagged):
+    """Deletes the cluster's load balancers of one type concurrently and
+    returns the descriptions of the ENIs they leave behind."""
+    if tagged is None:
+        lbs_to_remove = scan_load_balancers(elb, lt, cluster_name)
+    else:
+        lbs_to_remove = sorted(tagged[lt[0]])
+
+    if lbs_to_remove:
+        with metrics.phase("lb_delete"):
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = [
+                    executor.submit(delete_load_balancer, elb, lt, lb)
+                    for lb in lbs_to_remove
+                ]
+                for future in futures:
+                    future.result()
+
+    return [eni_description(lb) for lb in lbs_to_remove]
+
+
+def wait_released(ec2, descriptions, backoff):
+    """Waits until no ENI with one of the given descriptions is left.
+
+    All pending load balancers are checked together in batches of
+    DESCRIBE_BATCH, rather than one describe call per load balancer.
+    """
+    paginator = ec2.get_paginator("describe_network_interfaces")
+    pending = sorted(set(descriptions))
+
+    while pending:
+        found = set()
+        for pos in range(0, len(pending), DESCRIBE_BATCH):
+            filters = [
+                {"Name": "description", "Values": pending[pos : pos + DESCRIBE_BATCH]}
+            ]
+            for page in paginator.paginate(Filters=filters):
+                found.update(eni["Description"] for eni in page["NetworkInterfaces"])
+
+        pending = sorted(found)
+        if not pending:
+            return True
+
+        logger.info("Waiting for ENIs of %s to be released" % pending)
+        if not backoff.wait():
+            logger.warning("ENIs of %s still present, continuing" % pending)
+            return False
+
+    return True
 
 
 @helper.delete
 def delete_handler(event, _):
-    tag_key = "kubernetes.io/cluster/%s" % event["ResourceProperties"]["ClusterName"]
-    lb_types = [
-        [
-            "elb",
-            "LoadBalancerName",
-            "LoadBalancerNames",
-            "LoadBalancerDescriptions",
-            "LoadBalancerName",
-        ],
-        ["elbv2", "LoadBalancerArn", "ResourceArns", "LoadBalancers", "ResourceArn"],
-    ]
-    for lt in lb_types:
-        elb = boto3.client(lt[0])
-        lbs = []
-        response = elb.describe_load_balancers()
-
-        while True:
-            lbs += [l[lt[1]] for l in response[lt[3]]]
-            if "NextMarker" in response.keys():
-                response = elb.describe_load_balancers(Marker=response["NextMarker"])
-            else:
-                break
-
-        lbs_to_remove = []
-        if lbs:
-            # Split LB list into groups of 'size' items.
-            size = 20
-            lb_groups = (lbs[pos : pos + size] for pos in range(0, len(lbs), size))
-            for lb_group in lb_groups:
-                lb_group = elb.describe_tags(**{lt[2]: lb_group})["TagDescriptions"]
-                for tags in lb_group:
-                    for tag in tags["Tags"]:
-                        if tag["Key"] == tag_key and tag["Value"] == "owned":
-                            lbs_to_remove.append(tags[lt[4]])
-                        if (
-                            tag["Key"] == "elbv2.k8s.aws/cluster"
-                            and tag["Value"]
-                            == event["ResourceProperties"]["ClusterName"]
-                        ):
-                            lbs_to_remove.append(tags[lt[4]])
-
-        if lbs_to_remove:
-            for lb in lbs_to_remove:
-                logger.info("removing elb %s" % lb)
-                elb.delete_load_balancer(**{lt[1]: lb})
-
-    del_sgs(tag_key, event["ResourceProperties"]["ClusterName"])
-
-
-def del_sgs(tag_key, cluster_name):
+    cluster_name = event["ResourceProperties"]["ClusterName"]
+    tag_key = "kubernetes.io/cluster/%s" % cluster_name
+
+    with metrics.phase("lb_discover"):
+        tagged = discover_load_balancers(cluster_name)
+
+    # Clients are created up front as boto3 client creation isn't thread safe
+    clients = [(boto3.client(lt[0]), lt) for lt in LB_TYPES]
     ec2 = boto3.client("ec2")
+    descriptions = []
+
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        futures = [
+            executor.submit(delete_load_balancers, elb, lt, cluster_name, tagged)
+            for elb, lt in clients
+        ]
+        for future in futures:
+            descriptions += future.result()
+
+    # Security groups can't be deleted while the load balancers' ENIs still
+    # use them, so wait for those first instead of retrying every group
+    if descriptions:
+        with metrics.phase("eni_wait"):
+            backoff = Backoff(timeout=ENI_RELEASE_TIMEOUT, base=2, cap=15)
+            wait_released(ec2, descriptions, backoff)
+
+    with metrics.phase("sg_delete"):
+        del_sgs(ec2, tag_key, cluster_name)
+
+
+def delete_sg(ec2, sg_id):
+    backoff = Backoff(base=2, cap=15, attempts=SG_DELETE_ATTEMPTS)
+
+    while True:
+        try:
+            ec2.delete_security_group(GroupId=sg_id)
+            return
+        except ec2.exceptions.ClientError as e:
+            if "DependencyViolation" not in str(e):
+                # We don't know why it can't delete, so we're just
+                # logging it and moving on.
+                logger.exception("Unhandled exception")
+                return
+
+            logger.error("Dependency error on %s" % sg_id)
+
+            if not backoff.wait():
+                logger.error("Giving up on %s" % sg_id)
+                return
+
+            delete_dependencies(sg_id, ec2)
+
+
+def del_sgs(ec2, tag_key, cluster_name):
+    paginator = ec2.get_paginator("describe_tags")
     filters = [
         [
             {"Name": "tag:%s" % tag_key, "Values": ["owned"]},
@@ -116,35 +253,24 @@ def del_sgs(tag_key, cluster_name):
         ],
     ]
 
+    sg_ids = set()
     for f in filters:
-        response = ec2.describe_tags(Filters=f)
-        for t in [r["ResourceId"] for r in response["Tags"]]:
-            clean = False
-            retries = 10
-
-            while not clean and retries > 0:
-                try:
-                    ec2.delete_security_group(GroupId=t)
-                    clean = True
-                except ec2.exceptions.ClientError as e:
-                    if "DependencyViolation" in str(e):
-                        retries -= 1
-                        logger.error("Dependency error on %s" % t)
-
-                        sleep(5)
-
-                        delete_dependencies(t, ec2)
-                    else:
-                        # We don't know why it can't delete, so we're just
-                        # logging it and moving on.
-                        clean = True
-                        logger.exception("Unhandled exception")
+        for page in paginator.paginate(Filters=f):
+            sg_ids.update(r["ResourceId"] for r in page["Tags"])
+
+    if sg_ids:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(delete_sg, ec2, t) for t in sorted(sg_ids)]
+            for future in futures:
+                future.result()
 
 
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    metrics.set_dimensions(RequestType=event.get("RequestType", ""))
 
     logger.debug(json.dumps(event))
 
+    set_deadline(context)
     helper(event, context)
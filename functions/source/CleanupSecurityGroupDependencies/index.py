@@ -8,16 +8,26 @@
 import boto3
 import json
 import logging
+import math
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Provided through CrhelperLayer in amazon-eks-per-region-resources.template.yaml
 from crhelper import CfnResource
-from time import sleep
+
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.metrics import Metrics
+from quickstart_utils.retry import RESPONSE_BUFFER, Backoff, set_deadline
+from quickstart_utils.teardown import reference_index
 
 logger = logging.getLogger(__name__)
 
 ec2 = boto3.client("ec2")
 helper = CfnResource(json_logging=True, log_level="DEBUG")
+metrics = Metrics("CleanupSecurityGroupDependencies")
+
+MAX_WORKERS = 8
+DESCRIBE_BATCH = 200  # filter values allowed per describe call
 
 
 def get_attachment_id_for_eni(eni):
@@ -27,89 +37,186 @@ def get_attachment_id_for_eni(eni):
         return None
 
 
-def delete_dependencies(sg_id, security_groups):
+def revoke_references(index):
     complete = True
 
-    logger.info(f"Deleting dependencies for {sg_id}...")
+    # One call per referencing group and direction
+    for (group_id, direction), rules in index.items():
+        revoke = {
+            "ingress": ec2.revoke_security_group_ingress,
+            "egress": ec2.revoke_security_group_egress,
+        }[direction]
 
-    for sg in security_groups["SecurityGroups"]:
-        for p in sg["IpPermissions"]:
-            if "UserIdGroupPairs" in p.keys():
-                if sg_id in [x["GroupId"] for x in p["UserIdGroupPairs"]]:
-                    try:
-                        logger.debug(
-                            "Revoking ingress rule %s from %s..." % (p, sg["GroupId"])
-                        )
-                        ec2.revoke_security_group_ingress(
-                            GroupId=sg["GroupId"], IpPermissions=[p]
-                        )
-                        logger.debug(
-                            "Revoked ingress rule %s from %s." % (p, sg["GroupId"])
-                        )
-                    except Exception:
-                        complete = False
-                        logger.exception(
-                            "ERROR: Failed to revoke ingress rule %s from %s"
-                            % (p, sg["GroupId"])
-                        )
-
-                        continue
-
-    for sg in security_groups["SecurityGroups"]:
-        for p in sg["IpPermissionsEgress"]:
-            if "UserIdGroupPairs" in p.keys():
-                if sg_id in [x["GroupId"] for x in p["UserIdGroupPairs"]]:
-                    try:
-                        logger.debug(
-                            "Revoking egress rule %s from %s..." % (p, sg["GroupId"])
-                        )
-                        ec2.revoke_security_group_egress(
-                            GroupId=sg["GroupId"], IpPermissions=[p]
-                        )
-                        logger.debug(
-                            "Revoked egress rule %s from %s." % (p, sg["GroupId"])
-                        )
-                    except Exception:
-                        complete = False
-                        logger.exception(
-                            "ERROR: Failed to revoke ingress rule %s from %s"
-                            % (sg["GroupId"])
-                        )
-
-                        continue
-
-    filters = [{"Name": "group-id", "Values": [sg_id]}]
-    for eni in ec2.describe_network_interfaces(Filters=filters)["NetworkInterfaces"]:
         try:
-            attachment_id = get_attachment_id_for_eni(eni)
-            if attachment_id:
-                logger.debug(
-                    "Detaching ENI %s from %s..." % (eni["NetworkInterfaceId"], sg_id)
-                )
-                ec2.detach_network_interface(AttachmentId=attachment_id, Force=True)
-                logger.info(
-                    "Detached ENI %s from %s." % (eni["NetworkInterfaceId"], sg_id)
-                )
-
-                sleep(5)
-
-            logger.debug("Deleting ENI %s..." % (eni["NetworkInterfaceId"]))
-            ec2.delete_network_interface(NetworkInterfaceId=eni["NetworkInterfaceId"])
-            logger.info("Deleted ENI %s." % (eni["NetworkInterfaceId"]))
+            logger.debug(f"Revoking {direction} rules {rules} from {group_id}...")
+            revoke(GroupId=group_id, IpPermissions=rules)
+            logger.debug(f"Revoked {len(rules)} {direction} rules from {group_id}.")
         except Exception:
             complete = False
-            logger.exception("ERROR: %s" % (eni["NetworkInterfaceId"]))
+            logger.exception(
+                f"ERROR: Failed to revoke {direction} rules {rules} from {group_id}"
+            )
+
+    return complete
+
+
+def detach_eni(eni_id, attachment_id):
+    logger.debug("Detaching ENI %s..." % (eni_id))
+    ec2.detach_network_interface(AttachmentId=attachment_id, Force=True)
+    logger.info("Detached ENI %s." % (eni_id))
+
+
+def delete_eni(eni_id):
+    logger.debug("Deleting ENI %s..." % (eni_id))
+    ec2.delete_network_interface(NetworkInterfaceId=eni_id)
+    logger.info("Deleted ENI %s." % (eni_id))
+
+
+def wait_available(eni_ids, backoff):
+    """Waits until none of eni_ids is attached, polling them in batches.
+
+    Returns the ids that became available; deleted ENIs drop out.
+    """
+    waiting = set(eni_ids)
+    available = set()
 
-            continue
+    while waiting:
+        ids = sorted(waiting)
+        for i in range(0, len(ids), DESCRIBE_BATCH):
+            filters = [
+                {"Name": "network-interface-id", "Values": ids[i : i + DESCRIBE_BATCH]}
+            ]
+            found = set()
+            for eni in ec2.describe_network_interfaces(Filters=filters)[
+                "NetworkInterfaces"
+            ]:
+                found.add(eni["NetworkInterfaceId"])
+                if eni["Status"] == "available":
+                    available.add(eni["NetworkInterfaceId"])
+            waiting -= set(ids[i : i + DESCRIBE_BATCH]) - found
+
+        waiting -= available
+        if waiting and not backoff.wait():
+            logger.error(f"ERROR: ENIs still attached: {', '.join(sorted(waiting))}")
+            break
+
+    return available
+
+
+def run_concurrently(func, calls):
+    """Runs func over a list of argument tuples, logging failures by their
+    first argument. Returns whether every call succeeded."""
+    complete = True
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(func, *args): args[0] for args in calls}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                complete = False
+                logger.exception("ERROR: %s" % (futures[future]))
 
     return complete
 
 
+def delete_enis(enis, backoff):
+    """Detaches and deletes enis concurrently.
+
+    Deletion waits on the attachment state reported by EC2 rather than a
+    fixed sleep, with every ENI sharing the one backoff and its deadline.
+    """
+    attached = [
+        (eni["NetworkInterfaceId"], get_attachment_id_for_eni(eni))
+        for eni in enis
+        if get_attachment_id_for_eni(eni)
+    ]
+    complete = run_concurrently(detach_eni, attached)
+
+    eni_ids = [eni["NetworkInterfaceId"] for eni in enis]
+    available = wait_available(eni_ids, backoff)
+    if len(available) < len(eni_ids):
+        complete = False
+
+    deletes = [(eni_id,) for eni_id in sorted(available)]
+
+    return run_concurrently(delete_eni, deletes) and complete
+
+
+def delete_dependencies(sg_id, timeout=None):
+    logger.info(f"Deleting dependencies for {sg_id}...")
+
+    with metrics.phase("revoke"):
+        complete = revoke_references(reference_index(ec2, [sg_id]))
+
+    with metrics.phase("eni_delete"):
+        filters = [{"Name": "group-id", "Values": [sg_id]}]
+        enis = []
+        for page in ec2.get_paginator("describe_network_interfaces").paginate(
+            Filters=filters
+        ):
+            enis += page["NetworkInterfaces"]
+
+        complete = (
+            delete_enis(enis, Backoff(timeout=timeout, base=1, cap=5)) and complete
+        )
+
+    return complete
+
+
+def teardown_group(sg_id, timeout):
+    backoff = Backoff(timeout=timeout, base=2, cap=15)
+
+    while backoff.remaining() > 0:
+        try:
+            logger.debug(f"Querying security group {sg_id}...")
+            ec2.describe_security_groups(GroupIds=[sg_id])
+            logger.info(f"Found security group {sg_id}...")
+        except Exception:
+            logger.warning(f"{sg_id} not found. Skipping...")
+
+            break
+
+        if delete_dependencies(sg_id, backoff.remaining()):
+            try:
+                logger.debug(f"Deleting security group {sg_id}...")
+                ec2.delete_security_group(GroupId=sg_id)
+                logger.info(f"Deleted security group {sg_id}.")
+
+                break
+            except Exception:
+                logger.exception(f"ERROR: Failed to delete {sg_id}.")
+
+                # Dependencies just cleared, so the next attempt shouldn't sit
+                # out a long backoff
+                backoff.reset()
+
+                if not backoff.wait():
+                    message = f"ERROR: Out of retries deleting {sg_id}."
+                    logger.error(message)
+
+                    # raise RuntimeError(message)
+                    break
+
+                continue
+
+        logger.error(f"ERROR: Failed to delete {sg_id} dependencies. Retrying...")
+
+        if not backoff.wait():
+            message = f"ERROR: Out of retries deleting {sg_id} dependencies."
+            logger.error(message)
+
+            # raise RuntimeError(message)
+            break
+
+    logger.info(f"Processed {sg_id} successfully.")
+
+
 @helper.delete
 def delete_handler(event, context):
-    for sg_id in event.get("ResourceProperties", {}).get("SecurityGroups", {}):
-        interval = 15  # seconds
+    sg_ids = event.get("ResourceProperties", {}).get("SecurityGroups", {})
 
+    for sg_id in sg_ids:
         if not re.match(r"^sg-(?:[0-9a-f]{8}|[0-9a-f]{17})$", sg_id):
             message = f"ERROR: Invalid security group ID: {sg_id}."
             if len(str(sg_id)) == 1:
@@ -120,48 +227,19 @@ def delete_handler(event, context):
             logger.error(message)
             raise ValueError(message)
 
-        while context.get_remaining_time_in_millis() > (interval * 1000):
-            try:
-                logger.debug(f"Querying security group {sg_id}...")
-                security_groups = ec2.describe_security_groups(GroupIds=[sg_id])
-                logger.info(f"Found security group {sg_id}...")
-            except:
-                logger.warning(f"{sg_id} not found. Skipping...")
-
-                break
-
-            if delete_dependencies(sg_id, security_groups):
-                try:
-                    logger.debug(f"Deleting security group {sg_id}...")
-                    ec2.delete_security_group(GroupId=sg_id)
-                    logger.info(f"Deleted security group {sg_id}.")
-                except Exception:
-                    logger.exception(f"ERROR: Failed to delete {sg_id}.")
-
-                    if context.get_remaining_time_in_millis() <= (interval * 1000):
-                        message = f"ERROR: Out of retries deleting {sg_id}."
-                        logger.error(message)
-
-                        # raise RuntimeError(message)
-                        pass
-                    else:
-                        sleep(interval)
-
-                        continue
-
-            elif context.get_remaining_time_in_millis() <= (interval * 1000):
-                message = f"ERROR: Out of retries deleting {sg_id} dependencies."
-                logger.error(message)
-
-                # raise RuntimeError(message)
-            else:
-                logger.error(
-                    f"ERROR: Failed to delete {sg_id} dependencies. Retrying..."
-                )
+    # Rules referencing any of the groups are revoked up front in one pass, so
+    # a group that references another doesn't hold up its deletion
+    if sg_ids:
+        with metrics.phase("revoke"):
+            revoke_references(reference_index(ec2, sg_ids))
 
-                sleep(interval)
+    # Groups are torn down side by side; each wave of workers gets an equal
+    # share of the time left so one slow group can't starve the rest
+    waves = math.ceil(len(sg_ids) / MAX_WORKERS) or 1
+    share = (context.get_remaining_time_in_millis() / 1000 - RESPONSE_BUFFER) / waves
 
-        logger.info(f"Processed {sg_id} successfully.")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(lambda sg_id: teardown_group(sg_id, share), sg_ids))
 
     logger.info(f"Processed delete event successfully.")
 
@@ -169,6 +247,8 @@ def delete_handler(event, context):
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    metrics.set_dimensions(RequestType=event.get("RequestType", ""))
+    set_deadline(context)
 
     logger.debug(json.dumps(event))
 
@@ -2,7 +2,9 @@ import boto3
 import cfnresponse
 import json
 import logging
-from time import sleep
+
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.retry import Backoff, retry, retryable
 
 logger = logging.getLogger(__name__)
 
@@ -42,20 +44,18 @@ def handler(event, context):
             except iam.exceptions.EntityAlreadyExistsException as e:
                 logger.warning(e)
 
-            while True:
-                try:
-                    iam.attach_role_policy(
-                        RoleName="CloudFormation-Kubernetes-VPC",
-                        PolicyArn=f"arn:{partition}:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",
-                    )
-                    iam.attach_role_policy(
-                        RoleName="CloudFormation-Kubernetes-VPC",
-                        PolicyArn=f"arn:{partition}:iam::aws:policy/service-role/AWSLambdaENIManagementAccess",
-                    )
-                    break
-                except iam.exceptions.NoSuchEntityException as e:
-                    logger.warning(e)
-                    sleep(30)
+            # The new role can take a while to become visible to IAM
+            for policy in [
+                "AWSLambdaBasicExecutionRole",
+                "AWSLambdaENIManagementAccess",
+            ]:
+                retry(
+                    iam.attach_role_policy,
+                    RoleName="CloudFormation-Kubernetes-VPC",
+                    PolicyArn=f"arn:{partition}:iam::aws:policy/service-role/{policy}",
+                    when=retryable(iam.exceptions.NoSuchEntityException),
+                    backoff=Backoff(context, cap=30),
+                )
     except Exception:
         logger.exception("Unhandled exception")
         status = cfnresponse.FAILED
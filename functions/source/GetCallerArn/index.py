@@ -1,66 +1,126 @@
 import logging
 import json
 from datetime import timedelta
-from time import sleep
 import boto3
+from botocore.exceptions import ClientError
 
 # Provided through CrhelperLayer in amazon-eks-per-region-resources.template.yaml
 from crhelper import CfnResource
 import traceback
 
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.metrics import Metrics
+from quickstart_utils.retry import Backoff
+
 logger = logging.getLogger(__name__)
 helper = CfnResource(json_logging=True, log_level="DEBUG")
+metrics = Metrics("GetCallerArn")
+
+CACHE_PREFIX = "/eks-quickstart/GetCallerArn"
+# CreateStack lookup window around the root stack's creation time, doubled
+# after each lookup that misses, up to MAX_WINDOW either side
+WINDOW_BEFORE = timedelta(minutes=2)
+WINDOW_AFTER = timedelta(minutes=1)
+MAX_WINDOW = timedelta(minutes=30)
 
 try:
     cfn_client = boto3.client("cloudformation")
     ct_client = boto3.client("cloudtrail")
+    ssm_client = boto3.client("ssm")
 except Exception as init_exception:
     helper.init_failure(init_exception)
 
 
-def get_caller_arn(stack_id):
-    try:
-        root_id = cfn_client.describe_stacks(StackName=stack_id)["Stacks"][0]["RootId"]
-    except ValueError:
-        traceback.print_exc()
-        return "NotFound"
-    except IndexError:
-        traceback.print_exc()
-        return "NotFound"
+def cache_parameter(root_id):
+    # Stack ids end in a uuid, which is a valid SSM parameter name segment
+    return f"{CACHE_PREFIX}/{root_id.split('/')[-1]}"
 
-    create_time = cfn_client.describe_stacks(StackName=root_id)["Stacks"][0][
-        "CreationTime"
-    ]
 
-    retries = 50
+def get_root(stack_id):
+    stack = cfn_client.describe_stacks(StackName=stack_id)["Stacks"][0]
+
+    return stack.get("RootId", stack["StackId"]), stack
+
+
+def lookup_caller(root_id, create_time, context):
+    # LookupEvents takes a single lookup attribute, so events are fetched by
+    # resource name and filtered on event name here. CreateStack is logged at
+    # the moment the root stack was created, so a narrow window around its
+    # creation time keeps each lookup to a page or two. It widens on misses
+    # in case the recorded event time is further off.
+    backoff = Backoff(context, base=5, cap=30)
+    before, after = WINDOW_BEFORE, WINDOW_AFTER
+
     while True:
-        retries -= 1
+        window = {
+            "StartTime": create_time - before,
+            "EndTime": create_time + after,
+        }
+
         try:
-            response = ct_client.lookup_events(
+            pages = ct_client.get_paginator("lookup_events").paginate(
                 LookupAttributes=[
-                    {"AttributeKey": "ResourceName", "AttributeValue": root_id},
-                    {"AttributeKey": "EventName", "AttributeValue": "CreateStack"},
+                    {"AttributeKey": "ResourceName", "AttributeValue": root_id}
                 ],
-                StartTime=create_time - timedelta(minutes=15),
-                EndTime=create_time + timedelta(minutes=15),
+                **window,
             )
 
-            if len(response["Events"]) > 0:
-                return sts_to_role(
-                    json.loads(response["Events"][0]["CloudTrailEvent"])[
-                        "userIdentity"
-                    ]["arn"]
-                )
+            for page in pages:
+                for event in page["Events"]:
+                    if event["EventName"] == "CreateStack":
+                        return sts_to_role(
+                            json.loads(event["CloudTrailEvent"])["userIdentity"]["arn"]
+                        )
 
-            logger.info("Event not in cloudtrail yet, %s retries left" % str(retries))
+            logger.info("Event not in cloudtrail yet")
+            before = min(before * 2, MAX_WINDOW)
+            after = min(after * 2, MAX_WINDOW)
         except Exception:
             logger.exception("Unhandled exception")
 
-        if retries == 0:
+        if not backoff.wait():
             logger.warning("Ran out of retries!")
             return "NotFound"
 
-        sleep(15)
+
+def get_caller_arn(stack_id, context):
+    try:
+        root_id, stack = get_root(stack_id)
+    except ValueError:
+        traceback.print_exc()
+        return "NotFound"
+    except IndexError:
+        traceback.print_exc()
+        return "NotFound"
+
+    # Every nested stack under the same root resolves the same caller
+    try:
+        arn = ssm_client.get_parameter(Name=cache_parameter(root_id))["Parameter"][
+            "Value"
+        ]
+        logger.info(f"Caller cache hit for {root_id}")
+
+        return arn
+    except ssm_client.exceptions.ParameterNotFound:
+        logger.info(f"Caller cache miss for {root_id}")
+    except ClientError:
+        # The cache only saves a lookup, it must never change the result
+        logger.warning(f"Failed to read cached caller for {root_id}", exc_info=True)
+
+    if root_id != stack["StackId"]:
+        stack = cfn_client.describe_stacks(StackName=root_id)["Stacks"][0]
+
+    arn = lookup_caller(root_id, stack["CreationTime"], context)
+
+    if arn != "NotFound":
+        try:
+            ssm_client.put_parameter(
+                Name=cache_parameter(root_id), Value=arn, Type="String", Overwrite=True
+            )
+        except ClientError:
+            logger.warning(f"Failed to cache caller for {root_id}", exc_info=True)
+
+    return arn
 
 
 def sts_to_role(sts_arn):
@@ -80,9 +140,10 @@ def sts_to_role(sts_arn):
 
 
 @helper.create
-def create(event, _):
+def create(event, context):
     try:
-        arn = get_caller_arn(event["StackId"])
+        with metrics.phase("cloudtrail_lookup"):
+            arn = get_caller_arn(event["StackId"], context)
         helper.Data["Arn"] = arn
 
         if len(arn.split("/")) < 2:
@@ -96,8 +157,24 @@ def create(event, _):
         return "NotFound"
 
 
+@helper.delete
+def delete(event, _):
+    # The cached caller is dropped along with the root stack
+    try:
+        root_id, _ = get_root(event["StackId"])
+        status = cfn_client.describe_stacks(StackName=root_id)["Stacks"][0][
+            "StackStatus"
+        ]
+
+        if status == "DELETE_IN_PROGRESS":
+            ssm_client.delete_parameter(Name=cache_parameter(root_id))
+    except Exception:
+        logger.exception("Failed to remove cached caller arn")
+
+
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    metrics.set_dimensions(RequestType=event.get("RequestType", ""))
 
     helper(event, context)
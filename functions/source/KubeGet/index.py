@@ -1,20 +1,26 @@
 import boto3
 import json
 import logging
-import math
+import re
 import subprocess  # nosec B404
 import shlex
 import time
 from hashlib import md5
 from crhelper import CfnResource
 
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.eks import create_kubeconfig
+from quickstart_utils.metrics import Metrics
+from quickstart_utils.retry import Backoff
 
 logger = logging.getLogger(__name__)
 helper = CfnResource(json_logging=True, log_level="DEBUG")
+metrics = Metrics("KubeGet")
 
 try:
-    s3_client = boto3.client("s3")
-    kms_client = boto3.client("kms")
+    session = boto3.session.Session()
+    s3_client = session.client("s3")
+    kms_client = session.client("kms")
 except Exception as init_exception:
     helper.init_failure(init_exception)
 
@@ -36,49 +42,260 @@ def run_command(command):
     return output
 
 
-def create_kubeconfig(cluster_name):
-    run_command(
-        f"aws eks update-kubeconfig --name {cluster_name} --alias {cluster_name}"
-    )
-    run_command(f"kubectl config use-context {cluster_name}")
+class UnsupportedJsonPath(Exception):
+    pass
+
+
+def split_template(template: str):
+    # kubectl templates mix literal text with {expressions}
+    parts = []
+    while template:
+        start = template.find("{")
+        if start == -1:
+            parts.append(("text", template))
+            break
+        end = template.find("}", start)
+        if end == -1:
+            raise UnsupportedJsonPath(f"Unterminated expression in {template}")
+        if start:
+            parts.append(("text", template[:start]))
+        parts.append(("expr", template[start + 1 : end].strip()))
+        template = template[end + 1 :]
+
+    return parts
+
+
+def parse_path(expr: str):
+    """Parses the subset of kubectl JSONPath that a get needs: fields, quoted
+    keys, indexes, slices, wildcards and simple filters."""
+    if expr.startswith("$"):
+        expr = expr[1:]
+    if expr.startswith("range") or expr == "end" or ".." in expr:
+        raise UnsupportedJsonPath(expr)
+
+    steps = []
+    i = 0
+    while i < len(expr):
+        if expr[i] == ".":
+            i += 1
+            name = ""
+            while i < len(expr) and expr[i] not in ".[":
+                if expr[i] == "\\" and i + 1 < len(expr):
+                    i += 1
+                name += expr[i]
+                i += 1
+            if name == "*":
+                steps.append(("all", None))
+            elif name:
+                steps.append(("key", name))
+        elif expr[i] == "[":
+            end = expr.find("]", i)
+            if end == -1:
+                raise UnsupportedJsonPath(expr)
+            steps.append(parse_selector(expr[i + 1 : end].strip()))
+            i = end + 1
+        else:
+            raise UnsupportedJsonPath(expr)
+
+    return steps
+
+
+def parse_selector(selector: str):
+    if selector == "*":
+        return ("all", None)
+    if len(selector) > 1 and selector[0] in "'\"" and selector[-1] == selector[0]:
+        return ("key", selector[1:-1])
+    if selector.startswith("?(") and selector.endswith(")"):
+        match = re.fullmatch(
+            r"@((?:\.[\w-]+)+)\s*(?:(==|!=|<=|>=|<|>)\s*(.+))?", selector[2:-1].strip()
+        )
+        if not match:
+            raise UnsupportedJsonPath(selector)
+        path, op, value = match.groups()
+        if value is not None:
+            try:
+                value = json.loads(value.replace("'", '"'))
+            except ValueError:
+                raise UnsupportedJsonPath(selector)
+        return ("filter", (parse_path(path), op, value))
+    if ":" in selector:
+        bounds = [int(b) if b else None for b in selector.split(":")]
+        return ("slice", slice(*bounds))
+    try:
+        return ("index", int(selector))
+    except ValueError:
+        raise UnsupportedJsonPath(selector)
+
+
+def find(values: list, steps: list):
+    for step, arg in steps:
+        found = []
+        for value in values:
+            if step == "key" and isinstance(value, dict) and arg in value:
+                found.append(value[arg])
+            elif step == "all" and isinstance(value, dict):
+                found += list(value.values())
+            elif step == "all" and isinstance(value, list):
+                found += value
+            elif step == "index" and isinstance(value, list):
+                if -len(value) <= arg < len(value):
+                    found.append(value[arg])
+            elif step == "slice" and isinstance(value, list):
+                found += value[arg]
+            elif step == "filter" and isinstance(value, list):
+                found += [v for v in value if matches(v, *arg)]
+        values = found
+
+    return values
+
+
+def matches(value, path: list, op: str, expected):
+    found = find([value], path)
+    if op is None:
+        return bool(found)
+    if not found:
+        return False
+
+    actual = found[0]
+    try:
+        return {
+            "==": actual == expected,
+            "!=": actual != expected,
+            "<": actual < expected,
+            ">": actual > expected,
+            "<=": actual <= expected,
+            ">=": actual >= expected,
+        }[op]
+    except TypeError:
+        return False
+
+
+def render(value):
+    # Printed the way kubectl prints jsonpath results
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+    return json.dumps(value)
+
+
+def evaluate(document: dict, template: str):
+    """Evaluates a kubectl JSONPath template against a fetched object.
+
+    Missing keys render as empty, as kubectl does with -o jsonpath.
+    """
+    output = ""
+    for kind, part in split_template(template):
+        if kind == "text":
+            output += part
+        else:
+            output += " ".join(render(v) for v in find([document], parse_path(part)))
+
+    return output
+
+
+def get_queries(props: dict):
+    if "Queries" not in props:
+        return [
+            {
+                "Name": props["Name"],
+                "Namespace": props["Namespace"],
+                "JsonPath": props["JsonPath"],
+                "ResponseKey": props.get("ResponseKey"),
+            }
+        ]
+
+    queries = []
+    for query in props["Queries"]:
+        if "ResponseKey" not in query:
+            raise ValueError(f"Query for {query.get('Name')} has no ResponseKey")
+
+        queries.append(
+            {
+                "Name": query["Name"],
+                "Namespace": query.get("Namespace", props.get("Namespace", "default")),
+                "JsonPath": query["JsonPath"],
+                "ResponseKey": query["ResponseKey"],
+            }
+        )
+
+    return queries
+
+
+def run_query(query: dict, objects: dict):
+    name, namespace = query["Name"], query["Namespace"]
+
+    try:
+        for kind, part in split_template(query["JsonPath"]):
+            if kind == "expr":
+                parse_path(part)
+    except UnsupportedJsonPath:
+        logger.info(f"Evaluating {query['JsonPath']} with kubectl")
+
+        return run_command(
+            f'kubectl get {name} -o jsonpath="{query["JsonPath"]}" '
+            f"--namespace {namespace}"
+        )
+
+    # Each distinct object is fetched once however many queries read it
+    if (name, namespace) not in objects:
+        objects[(name, namespace)] = json.loads(
+            run_command(f"kubectl get {name} -o json --namespace {namespace}")
+        )
+
+    return evaluate(objects[(name, namespace)], query["JsonPath"])
 
 
 @helper.create
 @helper.update
 def create_handler(event, context):
-    create_kubeconfig(event["ResourceProperties"]["ClusterName"])
+    with metrics.phase("kubeconfig"):
+        expires = create_kubeconfig(event["ResourceProperties"]["ClusterName"])
 
     props = event.get("ResourceProperties", {})
-    name = props["Name"]
-    interval = 5
-    retry_timeout = (
-        math.floor(context.get_remaining_time_in_millis() / interval / 1000) - 1
-    )
-
-    namespace = props["Namespace"]
-    json_path = props["JsonPath"]
+    queries = get_queries(props)
+    backoff = Backoff(context, cap=15)
+    results = {}
 
     while True:
-        try:
-            outp = run_command(
-                f'kubectl get {name} -o jsonpath="{json_path}" --namespace {namespace}'
-            )
+        if time.time() >= expires:
+            expires = create_kubeconfig(event["ResourceProperties"]["ClusterName"])
+
+        # Objects are refetched on every pass, so a retry sees fresh state
+        objects = {}
+        for i, query in enumerate(queries):
+            if i in results:
+                continue
+
+            try:
+                with metrics.phase("get"):
+                    results[i] = run_query(query, objects)
+            except Exception:
+                logger.info(f"{query['Name']} not ready")
+
+        if len(results) == len(queries):
             break
-        except Exception:
-            if retry_timeout < 1:
-                message = "Out of retries"
-                logger.error(message)
-                raise RuntimeError(message)
-            else:
-                logger.info("Retrying until timeout...")
 
-                time.sleep(interval)
-                retry_timeout = retry_timeout - interval
+        logger.info("Retrying until timeout...")
+
+        if not backoff.wait():
+            message = "Out of retries"
+            logger.error(message)
+            raise RuntimeError(message)
 
     response_data = {"id": ""}
 
-    if "ResponseKey" in event["ResourceProperties"]:
-        response_data[event["ResourceProperties"]["ResponseKey"]] = outp
+    for i, query in enumerate(queries):
+        if query["ResponseKey"]:
+            response_data[query["ResponseKey"]] = results[i]
+
+    if "Queries" in props:
+        outp = json.dumps(response_data, sort_keys=True)
+    else:
+        outp = results[0]
 
     if len(outp.encode("utf-8")) > 1000:
         outp_utf8 = outp.encode("utf-8")
@@ -93,6 +310,7 @@ def create_handler(event, context):
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    metrics.set_dimensions(RequestType=event.get("RequestType", ""))
 
     logger.debug(json.dumps(event))
 
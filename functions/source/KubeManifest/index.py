@@ -1,91 +1,444 @@
+import copy
+import hashlib
 import json
 import logging
+import os
 import boto3
 import subprocess  # nosec B404
 import shlex
 import re
 import requests
+import tempfile
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from functools import lru_cache
 from crhelper import CfnResource
 from ruamel import yaml
-from time import sleep
+from time import sleep, time
+
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.eks import create_kubeconfig, get_cluster
+from quickstart_utils.metrics import Metrics
+from quickstart_utils.profiler import maybe_profile
+from quickstart_utils.retry import Backoff, retry, retryable, set_deadline
 
 logger = logging.getLogger(__name__)
 helper = CfnResource(json_logging=True, log_level="DEBUG")
+metrics = Metrics("KubeManifest")
+
+FIELD_MANAGER = "cloudformation"
+DIGEST_ANNOTATION = "eks-quickstart/manifest-digest"
+# seconds left for crhelper to report back to CloudFormation after stabilizing
+RESPONSE_BUFFER = 10
+INDEX_PATTERN = re.compile(r"\[[0-9]+\]")
+MAX_WORKERS = 8
+# CloudFormation rejects responses over 4096 bytes, leave room for the rest
+DATA_BUDGET = 3072
+MANIFEST_CACHE = "/tmp/manifests"  # nosec B108
+# Bundles are applied tier by tier, anything not listed here goes in the last
+# tier. Objects within a tier are applied concurrently.
+TIERS = [
+    ["Namespace", "CustomResourceDefinition"],
+    [
+        "ServiceAccount",
+        "Secret",
+        "ConfigMap",
+        "StorageClass",
+        "PersistentVolume",
+        "PersistentVolumeClaim",
+        "ClusterRole",
+        "ClusterRoleBinding",
+        "Role",
+        "RoleBinding",
+        "PriorityClass",
+        "LimitRange",
+        "ResourceQuota",
+    ],
+]
 
 try:
-    s3_client = boto3.client("s3")
-    kms_client = boto3.client("kms")
-    ec2_client = boto3.client("ec2")
+    session = boto3.session.Session()
+    s3_client = session.client("s3")
+    kms_client = session.client("kms")
+    ec2_client = session.client("ec2")
     s3_scheme = re.compile(r"^s3://.+/.+")
+    http_session = requests.Session()
 except Exception as init_exception:
     helper.init_failure(init_exception)
 
+# Kept for the life of the container, so warm invocations skip cluster setup
+kube_apis = {}
+no_proxy_cidrs = {}
+
+
+def cache_path(url: str):
+    return os.path.join(MANIFEST_CACHE, hashlib.sha256(url.encode()).hexdigest())
+
+
+def cache_read(url: str):
+    try:
+        with open(cache_path(url), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def cache_write(url: str, body: str, etag=None, last_modified=None):
+    os.makedirs(MANIFEST_CACHE, exist_ok=True)
+    path = cache_path(url)
+    entry = {"etag": etag, "last_modified": last_modified, "body": body}
+
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(entry, f)
+    os.replace(f"{path}.tmp", path)
+
 
 def s3_get(url: str):
+    cached = cache_read(url)
+
     try:
         bucket = url.split("/")[2]
         key = "/".join(url.split("/")[3:])
-        response = s3_client.get_object(Bucket=bucket, Key=key)
+        kwargs = {"Bucket": bucket, "Key": key}
+
+        if cached.get("etag"):
+            kwargs["IfNoneMatch"] = cached["etag"]
+
+        response = s3_client.get_object(**kwargs)
+        body = response["Body"].read().decode("utf8")
+        cache_write(url, body, etag=response.get("ETag"))
 
-        return response["Body"].read().decode("utf8")
+        return body
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["304", "NotModified"]:
+            logger.info(f"{url} not modified, using cached copy")
+
+            return cached["body"]
+
+        raise RuntimeError(f"Failed to fetch CustomValueYaml {url} from S3. {e}")
     except Exception as e:
         raise RuntimeError(f"Failed to fetch CustomValueYaml {url} from S3. {e}")
 
 
 def http_get(url: str):
+    cached = cache_read(url)
+    headers = {}
+
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
     try:
-        response = requests.get(url)
+        response = http_session.get(url, headers=headers, timeout=60)
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"Failed to fetch CustomValueYaml url {url}: {e}")
 
+    if response.status_code == 304 and cached:
+        logger.info(f"{url} not modified, using cached copy")
+
+        return cached["body"]
+
     if response.status_code != 200:
         raise RuntimeError(
             f"Failed to fetch CustomValueYaml url {url}: [{response.status_code}] "
             f"{response.reason}"
         )
 
+    if "ETag" in response.headers or "Last-Modified" in response.headers:
+        cache_write(
+            url,
+            response.text,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
     return response.text
 
 
+@lru_cache(maxsize=32)
+def _parse_yaml(content: str):
+    return tuple(yaml.safe_load_all(content))
+
+
+def load_yaml(content: str):
+    # Parsed documents are memoized on content, callers get their own copy to
+    # modify
+    return copy.deepcopy(list(_parse_yaml(content)))
+
+
 def run_command(command: str):
-    retries = 0
+    try:
+        return retry(
+            _run_command,
+            command,
+            when=retryable(messages=["Unable to connect to the server"]),
+            backoff=Backoff(attempts=6, cap=15),
+        )
+    except Exception as e:
+        raise RuntimeError(e)
+
+
+def _run_command(command: str):
+    try:
+        logger.debug(f"Executing command: {command}")
+        output = subprocess.check_output(  # nosec B603
+            shlex.split(command), stderr=subprocess.STDOUT
+        ).decode("utf-8")
+        logger.debug(output)
+    except subprocess.CalledProcessError as e:
+        logger.exception(
+            "Command failed with exit code %s, stderr: %s"
+            % (e.returncode, e.output.decode("utf-8"))
+        )
+
+        if "NotFound" in str(e):
+            logger.info("Continuing...")
+
+            pass
+        else:
+            raise RuntimeError(e.output.decode("utf-8"))
+    return output
+
+
+class Kubectl:
+    """Runs each operation as a kubectl command against a kubeconfig context."""
+
+    def __init__(self, cluster_name: str):
+        self.cluster_name = cluster_name
+        self.expires = create_kubeconfig(cluster_name)
+
+    def run(self, command: str, manifest):
+        if time() >= self.expires:
+            self.expires = create_kubeconfig(self.cluster_name)
+
+        # each call gets its own file so that bundles can be applied concurrently
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
 
-    while True:
         try:
-            try:
-                logger.debug(f"Executing command: {command}")
-                output = subprocess.check_output(  # nosec B603
-                    shlex.split(command), stderr=subprocess.STDOUT
-                ).decode("utf-8")
-                logger.debug(output)
-            except subprocess.CalledProcessError as e:
-                logger.exception(
-                    "Command failed with exit code %s, stderr: %s"
-                    % (e.returncode, e.output.decode("utf-8"))
-                )
-
-                if "NotFound" in str(e):
-                    logger.info("Continuing...")
-
-                    pass
-                else:
-                    raise RuntimeError(e.output.decode("utf-8"))
-            return output
-        except Exception as e:
-            if "Unable to connect to the server" not in str(e) or retries >= 5:
-                raise RuntimeError(e)
-
-            logger.debug("{}, retrying in 5 seconds".format(e))
+            write_manifest(manifest, path)
+
+            return run_command(f"{command} -f {path}")
+        finally:
+            os.remove(path)
+
+    def create(self, manifest):
+        return json.loads(self.run("kubectl create --save-config -o json", manifest))
+
+    def apply(self, manifest):
+        return json.loads(self.run("kubectl apply -o json", manifest))
+
+    def delete(self, manifest):
+        # Objects a partially failed create never made are already deleted,
+        # as with the 404 the native client treats as success
+        self.run("kubectl delete --ignore-not-found", manifest)
+
+    def get(self, manifest):
+        return json.loads(self.run("kubectl get -o json", manifest))
+
+    def patch(self, manifest, patch):
+        return json.loads(
+            self.run(
+                "kubectl patch -o json --type strategic "
+                f"-p {shlex.quote(json.dumps(patch))}",
+                manifest,
+            )
+        )
+
+    def watch(self, manifest, timeout: float):
+        deadline = time() + timeout
+
+        while True:
+            yield self.get(manifest)
+
+            if time() + 5 >= deadline:
+                return
+
             sleep(5)
-            retries += 1
 
 
-def create_kubeconfig(cluster_name: str):
-    run_command(
-        f"aws eks update-kubeconfig --name {cluster_name} --alias {cluster_name}"
-    )
-    run_command(f"kubectl config use-context {cluster_name}")
+class KubeApi:
+    """Talks to the cluster API server in-process.
+
+    A single keep-alive HTTPS session is reused for every call, authenticated
+    with a bearer token built from a presigned STS request.
+    """
+
+    def __init__(self, cluster_name: str):
+        self.cluster_name = cluster_name
+        self.resources = {}
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS)
+        )
+        self.session.headers["Content-Type"] = "application/json"
+        self.authorize()
+
+    def authorize(self):
+        cluster = get_cluster(self.cluster_name)
+        self.endpoint = cluster["endpoint"]
+        self.expires = cluster["expires"]
+        self.session.verify = cluster["ca_file"]
+        self.session.headers["Authorization"] = f"Bearer {cluster['token']}"
+
+    def request(self, method: str, path: str, **kwargs):
+        if time() >= self.expires:
+            self.authorize()
+
+        logger.debug(f"{method} {path}")
+        try:
+            response = retry(
+                self.session.request,
+                method,
+                self.endpoint + path,
+                timeout=60,
+                when=retryable(requests.exceptions.ConnectionError),
+                backoff=Backoff(attempts=6, cap=15),
+                **kwargs,
+            )
+        except requests.exceptions.ConnectionError as e:
+            raise RuntimeError(e)
+
+        if response.status_code == 404 and method == "DELETE":
+            logger.info(f"{path} NotFound, continuing...")
+
+            return {}
+
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+
+            raise RuntimeError(
+                f"{method} {path} failed: [{response.status_code}] {message}"
+            )
+
+        return response.json()
+
+    def api_resource(self, api_version: str, kind: str):
+        # kinds missing from the cache may belong to a CRD applied since the
+        # last discovery call, so those trigger a refresh
+        if kind not in self.resources.get(api_version, {}):
+            prefix = "/api/" if api_version == "v1" else "/apis/"
+            self.resources[api_version] = {
+                r["kind"]: r
+                for r in self.request("GET", prefix + api_version)["resources"]
+                if "/" not in r["name"]
+            }
+
+        if kind not in self.resources[api_version]:
+            raise RuntimeError(f"Kind {kind} not found in {api_version}")
+
+        return self.resources[api_version][kind]
+
+    def path(self, manifest, named=True):
+        api_version = manifest["apiVersion"]
+        resource = self.api_resource(api_version, manifest["kind"])
+        metadata = manifest.get("metadata", {})
+        path = ("/api/" if api_version == "v1" else "/apis/") + api_version
+
+        if resource["namespaced"]:
+            path += f"/namespaces/{metadata.get('namespace', 'default')}"
+        path += f"/{resource['name']}"
+
+        if named:
+            path += f"/{metadata['name']}"
+
+        return path
+
+    def create(self, manifest):
+        path = self.path(manifest, named=False)
+        response = self.request(
+            "POST", path, data=json.dumps(manifest, default=json_serial)
+        )
+        response["metadata"].setdefault(
+            "selfLink", f"{path}/{response['metadata']['name']}"
+        )
+
+        return response
+
+    def apply(self, manifest):
+        # server-side apply, taking ownership of fields previously set by
+        # `kubectl create --save-config`
+        return self.request(
+            "PATCH",
+            self.path(manifest),
+            params={"fieldManager": FIELD_MANAGER, "force": "true"},
+            data=json.dumps(manifest, default=json_serial),
+            headers={"Content-Type": "application/apply-patch+yaml"},
+        )
+
+    def delete(self, manifest):
+        self.request(
+            "DELETE", self.path(manifest), json={"propagationPolicy": "Background"}
+        )
+
+    def get(self, manifest):
+        return self.request("GET", self.path(manifest))
+
+    def patch(self, manifest, patch):
+        return self.request(
+            "PATCH",
+            self.path(manifest),
+            data=json.dumps(patch),
+            headers={"Content-Type": "application/strategic-merge-patch+json"},
+        )
+
+    def watch(self, manifest, timeout: float):
+        """Yields the object each time it changes, for at most timeout seconds.
+
+        Watching starts from the manifest's resourceVersion when it has one, so
+        no change made after that version is missed.
+        """
+        metadata = manifest["metadata"]
+        resource_version = metadata.get("resourceVersion")
+        url = self.endpoint + self.path(manifest, named=False)
+        deadline = time() + timeout
+
+        while time() < deadline:
+            if time() >= self.expires:
+                self.authorize()
+                url = self.endpoint + self.path(manifest, named=False)
+
+            params = {
+                "watch": "true",
+                "fieldSelector": f"metadata.name={metadata['name']}",
+                "timeoutSeconds": max(int(deadline - time()), 1),
+            }
+            if resource_version:
+                params["resourceVersion"] = resource_version
+
+            logger.debug(f"WATCH {url} {params}")
+            with self.session.get(
+                url,
+                params=params,
+                stream=True,
+                timeout=(10, params["timeoutSeconds"] + 30),
+            ) as response:
+                if response.status_code >= 400:
+                    raise RuntimeError(
+                        f"WATCH {url} failed: [{response.status_code}] {response.text}"
+                    )
+
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+
+                    event = json.loads(line)
+                    if event["type"] == "ERROR":
+                        # typically 410 Gone once resourceVersion has been
+                        # compacted, restart from the current state
+                        logger.debug(f"Watch error: {event['object']}")
+                        resource_version = None
+
+                        break
+
+                    resource_version = event["object"]["metadata"]["resourceVersion"]
+                    if event["type"] in ["ADDED", "MODIFIED"]:
+                        yield event["object"]
 
 
 def json_serial(o):
@@ -101,11 +454,7 @@ def write_manifest(manifest: str, path: str):
     f.close()
 
 
-def generate_name(event, physical_resource_id):
-    manifest = event["ResourceProperties"]["Manifest"]
-
-    if type(manifest) == str:
-        manifest = yaml.safe_load(manifest)
+def generate_name(manifest, event, physical_resource_id):
     stack_name = event["StackId"].split("/")[1]
 
     if "metadata" in manifest.keys():
@@ -137,35 +486,229 @@ def build_output(kube_response):
     return outp
 
 
+def manifest_digest(manifest):
+    canonical = json.dumps(
+        manifest, sort_keys=True, separators=(",", ":"), default=json_serial
+    )
+
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def annotate_digest(manifest):
+    # The digest covers the manifest as normalized by generate_name/fix_types,
+    # before the annotation itself is added.
+    digest = manifest_digest(manifest)
+    metadata = manifest.setdefault("metadata", {})
+    metadata["annotations"] = metadata.get("annotations") or {}
+    metadata["annotations"][DIGEST_ANNOTATION] = digest
+
+    return manifest
+
+
+def apply_changed(client, manifest):
+    try:
+        live = client.get(manifest)
+    except RuntimeError:
+        live = {}
+
+    annotations = live.get("metadata", {}).get("annotations") or {}
+    digest = manifest["metadata"]["annotations"][DIGEST_ANNOTATION]
+
+    if annotations.get(DIGEST_ANNOTATION) == digest:
+        logger.info(f"{object_key(live)} is unchanged, skipping apply")
+
+        return live
+
+    return client.apply(manifest)
+
+
+def object_key(kube_response):
+    metadata = kube_response["metadata"]
+
+    return "/".join(
+        [
+            p
+            for p in [
+                kube_response["kind"],
+                metadata.get("namespace"),
+                metadata["name"],
+            ]
+            if p
+        ]
+    )
+
+
+def build_bundle_output(kube_responses):
+    outp = {}
+
+    for kube_response in kube_responses:
+        key = object_key(kube_response)
+        for field, value in build_output(kube_response).items():
+            if field in ["uid", "selfLink"]:
+                outp[f"{key}/{field}"] = value
+
+    if len(json.dumps(outp)) <= DATA_BUDGET:
+        return outp
+
+    # Too large for the response, so keep as many uids as fit and log the rest
+    logger.info(f"Bundle output: {json.dumps(outp)}")
+    trimmed = {}
+
+    for key, value in outp.items():
+        if not key.endswith("/uid"):
+            continue
+
+        if len(json.dumps({**trimmed, key: value})) > DATA_BUDGET:
+            break
+
+        trimmed[key] = value
+
+    logger.warning(
+        f"Returning {len(trimmed)} of {len(outp)} bundle attributes to stay "
+        "within the CloudFormation response limit"
+    )
+
+    return trimmed
+
+
+def split_manifests(manifests):
+    objects = []
+
+    for manifest in manifests:
+        if not manifest:
+            continue
+
+        if manifest.get("kind", "").endswith("List") and "items" in manifest:
+            objects += split_manifests(manifest["items"])
+        else:
+            objects.append(manifest)
+
+    return objects
+
+
+def manifest_tier(manifest):
+    for idx, kinds in enumerate(TIERS):
+        if manifest.get("kind") in kinds:
+            return idx
+
+    return len(TIERS)
+
+
+def wait_established(client, crd):
+    backoff = Backoff(cap=10)
+
+    while True:
+        response = client.get(crd)
+
+        for condition in response.get("status", {}).get("conditions", []):
+            if condition.get("type") == "Established":
+                if condition.get("status") == "True":
+                    return
+
+        if not backoff.wait():
+            raise RuntimeError(
+                f"CustomResourceDefinition {crd['metadata']['name']} not established"
+            )
+
+
+def apply_bundle(client, manifests, action, reverse=False):
+    tiers = {}
+    for manifest in manifests:
+        if "name" not in manifest.get("metadata", {}):
+            raise ValueError(
+                f"{manifest.get('kind')} in a multi-object manifest has no "
+                "metadata.name"
+            )
+        tiers.setdefault(manifest_tier(manifest), []).append(manifest)
+
+    kube_responses = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for tier in sorted(tiers, reverse=reverse):
+            logger.debug(
+                f"Processing tier {tier}: {[object_key(m) for m in tiers[tier]]}"
+            )
+            kube_responses += list(pool.map(action, tiers[tier]))
+
+            if action != client.delete:
+                crds = [
+                    m for m in tiers[tier] if m["kind"] == "CustomResourceDefinition"
+                ]
+                list(pool.map(lambda crd: wait_established(client, crd), crds))
+
+    return kube_responses
+
+
+def _keys(obj):
+    return iter(obj) if isinstance(obj, dict) else iter(range(len(obj)))
+
+
 def traverse(obj, path=None, callback=None):
+    """Walks obj children first, replacing each node with callback(path, node).
+
+    The walk is iterative and edits dicts and lists in place. path is a single
+    list updated as the walk goes, so a callback that keeps it must copy it.
+    """
+    if callback is None:
+        return obj
+
     if path is None:
         path = []
 
-    if isinstance(obj, dict):
-        value = {k: traverse(v, path + [k], callback) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        value = [
-            traverse(obj[idx], path + [[idx]], callback) for idx in range(len(obj))
-        ]
-    else:
-        value = obj
+    if not isinstance(obj, (dict, list)):
+        return callback(path, obj)
 
-    if callback is None:
-        return value
-    else:
-        return callback(path, value)
+    stack = [(obj, _keys(obj))]
+    while stack:
+        node, keys = stack[-1]
 
+        for key in keys:
+            child = node[key]
+            path.append(key if isinstance(node, dict) else [key])
 
-def traverse_modify(obj, target_path, action):
-    target_path = to_path(target_path)
+            if isinstance(child, (dict, list)):
+                stack.append((child, _keys(child)))
 
-    def transformer(path, value):
-        if path == target_path:
-            return action(value)
+                break
+
+            node[key] = callback(path, child)
+            path.pop()
         else:
-            return value
+            stack.pop()
 
-    return traverse(obj, callback=transformer)
+            if stack:
+                parent = stack[-1][0]
+                key = path[-1] if isinstance(parent, dict) else path[-1][0]
+                parent[key] = callback(path, node)
+                path.pop()
+
+    return callback(path, obj)
+
+
+def traverse_modify(obj, target_path, action):
+    # Only the nodes along target_path are visited
+    target_path = compile_path(target_path)
+
+    if not target_path:
+        return action(obj)
+
+    parent = None
+    node = obj
+    for part in target_path:
+        if isinstance(part, list):
+            if not isinstance(node, list) or part[0] >= len(node):
+                return obj
+            key = part[0]
+        else:
+            if not isinstance(node, dict) or part not in node:
+                return obj
+            key = part
+
+        parent = node
+        node = node[key]
+
+    parent[key] = action(node)
+
+    return obj
 
 
 def traverse_modify_all(obj, action):
@@ -175,24 +718,32 @@ def traverse_modify_all(obj, action):
     return traverse(obj, callback=transformer)
 
 
-def to_path(path):
+@lru_cache(maxsize=256)
+def _compile_path(path: str):
+    indexes = [[int(i[1:-1])] for i in INDEX_PATTERN.findall(path)]
+    lists = INDEX_PATTERN.split(path)
+    parts = []
+
+    for idx in range(len(lists)):
+        parts += lists[idx].strip(".").split(".")
+
+        if idx < len(indexes):
+            parts.append(indexes[idx])
+        else:
+            parts.append([])
+
+    return tuple(parts[:-1])
+
+
+def compile_path(path):
     if isinstance(path, list):
         return path  # already in list format
 
-    def _iter_path(inner_path):
-        indexes = [[int(i[1:-1])] for i in re.findall(r"\[[0-9]+\]", inner_path)]
-        lists = re.split(r"\[[0-9]+\]", inner_path)
-
-        for parts in range(len(lists)):
-            for part in lists[parts].strip(".").split("."):
-                yield part
+    return _compile_path(path)
 
-            if parts < len(indexes):
-                yield indexes[parts]
-            else:
-                yield []
 
-    return list(_iter_path(path))[:-1]
+def to_path(path):
+    return list(compile_path(path))
 
 
 def set_type(input_str):
@@ -213,7 +764,70 @@ def fix_types(manifest):
     return traverse_modify_all(manifest, set_type)
 
 
-def enable_proxy(proxy_host, vpc_id):
+def proxy_patch(daemonset, configmap):
+    # Equivalent of `kubectl set env --from=configmap/... --containers='*'`
+    # combined with an envFrom reference on every container.
+    name = configmap["metadata"]["name"]
+    env = [
+        {"name": k, "valueFrom": {"configMapKeyRef": {"name": name, "key": k}}}
+        for k in configmap["data"]
+    ]
+    containers = [
+        {"name": c["name"], "envFrom": [{"configMapRef": {"name": name}}], "env": env}
+        for c in daemonset["spec"]["template"]["spec"]["containers"]
+    ]
+
+    return {"spec": {"template": {"spec": {"containers": containers}}}}
+
+
+def proxy_in_place(daemonset, configmap):
+    name = configmap["metadata"]["name"]
+    env_from = {"configMapRef": {"name": name}}
+
+    for container in daemonset["spec"]["template"]["spec"]["containers"]:
+        if env_from not in (container.get("envFrom") or []):
+            return False
+
+        env = {e["name"]: e.get("valueFrom") for e in container.get("env") or []}
+        for key in configmap["data"]:
+            if env.get(key) != {"configMapKeyRef": {"name": name, "key": key}}:
+                return False
+
+    return True
+
+
+def get_no_proxy_cidrs(client, vpc_id):
+    key = (client.cluster_name, vpc_id)
+
+    if key not in no_proxy_cidrs:
+        service = client.get(
+            {
+                "apiVersion": "v1",
+                "kind": "Service",
+                "metadata": {"name": "kubernetes", "namespace": "default"},
+            }
+        )
+        cluster_ip = service["spec"]["clusterIP"]
+        cluster_cidr = ".".join(cluster_ip.split(".")[:3]) + ".0/16"
+        vpc = ec2_client.describe_vpcs(VpcIds=[vpc_id])["Vpcs"][0]
+        no_proxy_cidrs[key] = f"{vpc['CidrBlock']},{cluster_cidr}"
+
+    return no_proxy_cidrs[key]
+
+
+def rollout_proxy(client, daemonset, configmap):
+    live = client.get(daemonset)
+
+    if proxy_in_place(live, configmap):
+        logger.info(f"Proxy already configured on {object_key(live)}")
+
+        return
+
+    patch = proxy_patch(live, configmap)
+    logger.debug(json.dumps(client.patch(daemonset, patch), default=json_serial))
+
+
+def enable_proxy(client, proxy_host, vpc_id):
     configmap = {
         "apiVersion": "v1",
         "kind": "ConfigMap",
@@ -221,83 +835,90 @@ def enable_proxy(proxy_host, vpc_id):
         "data": {
             "HTTP_PROXY": proxy_host,
             "HTTPS_PROXY": proxy_host,
-            "NO_PROXY": "localhost,127.0.0.1,169.254.169.254,.internal",
+            "NO_PROXY": "localhost,127.0.0.1,169.254.169.254,.internal,"
+            + get_no_proxy_cidrs(client, vpc_id),
         },
     }
-    cluster_ip = run_command(
-        "kubectl get service/kubernetes -o jsonpath='{.spec.clusterIP}'"
-    )
-    cluster_cidr = ".".join(cluster_ip.split(".")[:3]) + ".0/16"
-    vpc_cidr = ec2_client.describe_vpcs(VpcIds=[vpc_id])["Vpcs"][0]["CidrBlock"]
-    configmap["data"]["NO_PROXY"] += f"{vpc_cidr},{cluster_cidr}"
-
-    file_path = "/tmp/proxy.json"  # nosec B108
-    write_manifest(configmap, file_path)
 
-    run_command(f"kubectl apply -f {file_path}")
+    try:
+        live = client.get(configmap)
+    except RuntimeError:
+        live = {}
 
-    patch_cmd = (
-        """kubectl patch -n kube-system -p '{ "spec": {"template": { "spec": { """
-        """"containers": [ { "name": "%s", "envFrom": [ { "configMapRef": {"name": """
-        """"proxy-environment-variables"} } ] } ] } } } }' daemonset %s"""
-    )
-    setenv_cmd = (
-        """kubectl set env daemonset/%s --namespace=kube-system """
-        """--from=configmap/proxy-environment-variables --containers='*'"""
-    )
+    if live.get("data") != configmap["data"]:
+        client.apply(configmap)
 
-    for pod in ["aws-node", "kube-proxy"]:
-        logger.debug(run_command(patch_cmd % (pod, pod)))
-        logger.debug(run_command(setenv_cmd % pod))
+    daemonsets = [
+        {
+            "apiVersion": "apps/v1",
+            "kind": "DaemonSet",
+            "metadata": {"name": name, "namespace": "kube-system"},
+        }
+        for name in ["aws-node", "kube-proxy"]
+    ]
+    with ThreadPoolExecutor(max_workers=len(daemonsets)) as pool:
+        list(pool.map(lambda d: rollout_proxy(client, d, configmap), daemonsets))
 
 
 def handler_init(event):
     physical_resource_id = None
-    manifest_file = None
+    manifests = []
 
     props = event.get("ResourceProperties", {})
-    create_kubeconfig(props["ClusterName"])
+
+    with metrics.phase("kubeconfig"):
+        if props.get("KubeClient", "kubectl") == "native":
+            if props["ClusterName"] in kube_apis:
+                client = kube_apis[props["ClusterName"]]
+                client.authorize()
+            else:
+                client = KubeApi(props["ClusterName"])
+                kube_apis[props["ClusterName"]] = client
+        else:
+            client = Kubectl(props["ClusterName"])
 
     if "HttpProxy" in props.keys() and event["RequestType"] != "Delete":
-        enable_proxy(props["HttpProxy"], props["VpcId"])
+        with metrics.phase("proxy"):
+            enable_proxy(client, props["HttpProxy"], props["VpcId"])
 
     if "Manifest" in props.keys():
-        manifest_file = "/tmp/manifest.json"  # nosec B108
-
         if "PhysicalResourceId" in event.keys():
             physical_resource_id = event["PhysicalResourceId"]
 
         if type(props["Manifest"]) == str:
-            manifest = generate_name(event, physical_resource_id)
+            manifests = split_manifests(load_yaml(props["Manifest"]))
+        elif type(props["Manifest"]) == list:
+            manifests = split_manifests([fix_types(m) for m in props["Manifest"]])
         else:
-            manifest = fix_types(generate_name(event, physical_resource_id))
+            manifests = split_manifests([fix_types(props["Manifest"])])
+
+        if len(manifests) == 1:
+            manifests = [generate_name(manifests[0], event, physical_resource_id)]
 
-        write_manifest(manifest, manifest_file)
         logger.debug(
-            "Applying manifest: %s" % json.dumps(manifest, default=json_serial)
+            "Applying manifest: %s" % json.dumps(manifests, default=json_serial)
         )
     elif "Url" in props.keys():
-        manifest_file = "/tmp/manifest.json"  # nosec B108
         url = props["Url"]
 
-        if re.match(s3_scheme, url):
-            response = s3_get(url)
-        else:
-            response = http_get(url)
+        with metrics.phase("fetch_manifest"):
+            if re.match(s3_scheme, url):
+                response = s3_get(url)
+            else:
+                response = http_get(url)
 
-        manifest = yaml.safe_load(response)
+            manifests = split_manifests(load_yaml(response))
 
-        write_manifest(manifest, manifest_file)
+    manifests = [annotate_digest(m) for m in manifests]
 
-    return physical_resource_id, manifest_file
+    return physical_resource_id, manifests, client
 
 
-def stabilize_job(namespace, name):
-    while True:
-        response = json.loads(
-            run_command(f"kubectl get job/{name} -n {namespace} -o json")
-        )
+def stabilize_job(client, job, context):
+    timeout = context.get_remaining_time_in_millis() / 1000 - RESPONSE_BUFFER
+    name = job["metadata"]["name"]
 
+    for response in client.watch(job, timeout):
         for condition in response.get("status", {}).get("conditions", []):
             if condition.get("status") == "True":
                 if condition.get("type") == "Complete":
@@ -308,53 +929,80 @@ def stabilize_job(namespace, name):
                         f"Job failed {condition.get('reason')} {condition.get('message')}"
                     )
 
-        sleep(5)
+    raise RuntimeError(f"Timed out waiting for job {name} to complete")
 
 
 @helper.create
-def create_handler(event, _):
-    physical_resource_id, manifest_file = handler_init(event)
+def create_handler(event, context):
+    physical_resource_id, manifests, client = handler_init(event)
+
+    if not manifests:
+        return physical_resource_id
+
+    if len(manifests) > 1:
+        with metrics.phase("apply"):
+            responses = apply_bundle(client, manifests, client.create)
+        helper.Data = build_bundle_output(responses)
 
-    if not manifest_file:
         return physical_resource_id
 
-    outp = run_command(f"kubectl create --save-config -o json -f {manifest_file}")
-    helper.Data = build_output(json.loads(outp))
+    with metrics.phase("apply"):
+        response = client.create(manifests[0])
+    helper.Data = build_output(response)
 
-    self_link = helper.Data.get("selfLink", "")
-    if self_link.startswith("/apis/batch") and "cronjobs" not in self_link:
-        stabilize_job(helper.Data["namespace"], helper.Data["name"])
+    if response["kind"] == "Job" and response["apiVersion"].startswith("batch/"):
+        with metrics.phase("stabilize"):
+            stabilize_job(client, response, context)
 
     return helper.Data.get("selfLink", physical_resource_id)
 
 
 @helper.update
 def update_handler(event, _):
-    physical_resource_id, manifest_file = handler_init(event)
+    physical_resource_id, manifests, client = handler_init(event)
 
-    if not manifest_file:
+    if not manifests:
         return physical_resource_id
 
-    outp = run_command("kubectl apply -o json -f %s" % manifest_file)
-    helper.Data = build_output(json.loads(outp))
+    def action(manifest):
+        return apply_changed(client, manifest)
+
+    if len(manifests) > 1:
+        with metrics.phase("apply"):
+            responses = apply_bundle(client, manifests, action)
+        helper.Data = build_bundle_output(responses)
+
+        return physical_resource_id
+
+    with metrics.phase("apply"):
+        response = action(manifests[0])
+    helper.Data = build_output(response)
 
     return helper.Data.get("selfLink", physical_resource_id)
 
 
 @helper.delete
 def delete_handler(event, _):
-    physical_resource_id, manifest_file = handler_init(event)
+    physical_resource_id, manifests, client = handler_init(event)
 
-    if not manifest_file:
+    if not manifests:
         return physical_resource_id
 
-    run_command("kubectl delete -f %s" % manifest_file)
+    with metrics.phase("apply"):
+        if len(manifests) > 1:
+            apply_bundle(client, manifests, client.delete, reverse=True)
+        else:
+            client.delete(manifests[0])
 
 
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    metrics.set_dimensions(RequestType=event.get("RequestType", ""))
+
+    set_deadline(context)
 
     logger.debug(json.dumps(event))
 
-    helper(event, context)
+    with maybe_profile(props, f"KubeManifest-{context.aws_request_id}"):
+        helper(event, context)
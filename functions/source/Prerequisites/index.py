@@ -1,61 +1,306 @@
 import boto3
 import cfnresponse
+import hashlib
 import json
 import logging
 from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from random import randint
-from time import sleep
+from threading import Event, Thread
+from time import sleep, time
 from uuid import uuid4
 
+# Provided through QuickStartUtilsLayer in amazon-eks-prerequisites.template.yaml
+from quickstart_utils.metrics import Metrics
+from quickstart_utils.retry import Backoff, remaining, set_deadline
+
 logger = logging.getLogger(__name__)
+metrics = Metrics("Prerequisites")
 
 CONFIG = Config(retries={"max_attempts": 10, "mode": "standard"})
+MAX_WORKERS = 8
+MIN_POLL = 2  # seconds between stack event polls
+MAX_POLL = 30
+# Created by templates/amazon-eks-locks.template.yaml. The lease guards the
+# account-wide stack, so every region locks in the same one.
+LOCK_TABLE = "eks-quickstart-locks"
+LOCK_REGIONS = {"cn-": "cn-north-1", "us-gov-": "us-gov-west-1"}
+DEFAULT_LOCK_REGION = "us-east-1"
+LEASE_DURATION = 120  # seconds, renewed every third of that while held
+
+
+def lock_region(region):
+    for prefix, lock in LOCK_REGIONS.items():
+        if region.startswith(prefix):
+            return lock
+
+    return DEFAULT_LOCK_REGION
+
+
+class Lease:
+    """Lock held through a conditional write to a DynamoDB item.
+
+    The item records its owner and an expiry that a background thread keeps
+    pushing forward, so a holder that dies stops blocking others once the
+    lease runs out. Waiters poll with backoff until the invocation deadline.
+    Without the lock table it falls back to a random delay, which only makes
+    concurrent deployments less likely to race.
+    """
+
+    def __init__(self, name, duration=LEASE_DURATION, table=LOCK_TABLE):
+        self.name = name
+        self.duration = duration
+        self.table = table
+        self.owner = uuid4().hex
+        self.client = boto3.client(
+            "dynamodb",
+            region_name=lock_region(boto3.session.Session().region_name),
+            config=CONFIG,
+        )
+        self.held = False
+        self.released = Event()
+        self.renewer = Thread(target=self.renew, daemon=True)
+
+    def table_exists(self):
+        try:
+            self.client.describe_table(TableName=self.table)
+
+            return True
+        except self.client.exceptions.ResourceNotFoundException:
+            region = self.client.meta.region_name
+            logger.warning(
+                f"Lock table {self.table} not found in {region}, deploying "
+                f"{self.name} after a random delay instead. Deploy "
+                f"amazon-eks-locks.template.yaml in {region} to serialize "
+                "concurrent deployments."
+            )
+
+            return False
+
+    def try_acquire(self):
+        now = int(time())
+
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={
+                    "id": {"S": self.name},
+                    "owner": {"S": self.owner},
+                    "expires": {"N": str(now + self.duration)},
+                },
+                ConditionExpression="attribute_not_exists(#id) OR #expires < :now",
+                ExpressionAttributeNames={"#id": "id", "#expires": "expires"},
+                ExpressionAttributeValues={":now": {"N": str(now)}},
+            )
+
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def renew(self):
+        while not self.released.wait(self.duration / 3):
+            try:
+                self.client.update_item(
+                    TableName=self.table,
+                    Key={"id": {"S": self.name}},
+                    UpdateExpression="SET #expires = :expires",
+                    ConditionExpression="#owner = :owner",
+                    ExpressionAttributeNames={"#owner": "owner", "#expires": "expires"},
+                    ExpressionAttributeValues={
+                        ":expires": {"N": str(int(time()) + self.duration)},
+                        ":owner": {"S": self.owner},
+                    },
+                )
+            except Exception:
+                logger.exception(f"Failed to renew lease on {self.name}")
+
+    def __enter__(self):
+        if not self.table_exists():
+            # jitter to reduce the chance of concurrent deployments racing
+            sleep(min(randint(0, 6000) / 100, max(remaining(), 0)))  # nosec B311
+
+            return self
+
+        backoff = Backoff(base=1, cap=10)
+
+        while not self.try_acquire():
+            logger.info(f"{self.name} is locked, waiting")
+
+            if not backoff.wait():
+                raise RuntimeError(f"Timed out waiting for lock on {self.name}")
+
+        logger.info(f"Acquired lock on {self.name}")
+        self.held = True
+        self.renewer.start()
+
+        return self
+
+    def __exit__(self, *_):
+        if not self.held:
+            return
+
+        self.released.set()
+        self.renewer.join()
+
+        try:
+            self.client.delete_item(
+                TableName=self.table,
+                Key={"id": {"S": self.name}},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":owner": {"S": self.owner}},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            logger.warning(f"Lease on {self.name} expired before release")
+
+
+def stack_events(cfn_client, stack_id, cursor):
+    """Returns the events newer than cursor, oldest first.
+
+    Without a cursor, events are read back to the start of the stack's
+    current operation.
+    """
+    events = []
+    kwargs = {"StackName": stack_id}
+
+    while True:
+        page = cfn_client.describe_stack_events(**kwargs)
+
+        for event in page["StackEvents"]:
+            if event["EventId"] == cursor:
+                return events[::-1]
+
+            events.append(event)
+
+            if (
+                cursor is None
+                and event["PhysicalResourceId"] == stack_id
+                and event["ResourceStatus"].endswith("_IN_PROGRESS")
+                and event.get("ResourceStatusReason") == "User Initiated"
+            ):
+                return events[::-1]
+
+        if "NextToken" not in page:
+            return events[::-1]
+
+        kwargs["NextToken"] = page["NextToken"]
 
 
 def waiter(cfn_client, operation, stack_id):
     logger.info(f"waiter({operation}, {stack_id}) started")
-    retries = 50
+    cursor = None
+    pending = set()
+    failure = None
+    interval = MIN_POLL
 
     while True:
-        retries -= 1
-        response = cfn_client.describe_stacks(StackName=stack_id)
-        stack = response["Stacks"][0]
-        status = stack["StackStatus"]
-        if status in ["CREATE_COMPLETE", "UPDATE_COMPLETE"]:
-            break
-
-        if (
-            status.endswith("FAILED")
-            or status in ["DELETE_COMPLETE", "UPDATE_ROLLBACK_COMPLETE"]
-            or retries == 0
-        ):
+        events = stack_events(cfn_client, stack_id, cursor)
+
+        for event in events:
+            status = event["ResourceStatus"]
+
+            if event["PhysicalResourceId"] == stack_id:
+                if status in ["CREATE_COMPLETE", "UPDATE_COMPLETE"] or (
+                    operation == "delete" and status == "DELETE_COMPLETE"
+                ):
+                    logger.info(f"waiter({operation}, {stack_id}) done")
+
+                    return
+
+                if status.endswith("FAILED") or status in [
+                    "DELETE_COMPLETE",
+                    "ROLLBACK_COMPLETE",
+                    "UPDATE_ROLLBACK_COMPLETE",
+                ]:
+                    raise RuntimeError(
+                        f"Stack operation failed: {operation} {status} {stack_id}"
+                        + (f": {failure}" if failure else "")
+                    )
+
+                continue
+
+            if status.endswith("_IN_PROGRESS"):
+                pending.add(event["LogicalResourceId"])
+            else:
+                pending.discard(event["LogicalResourceId"])
+
+            if status.endswith("_FAILED") and failure is None:
+                failure = (
+                    f"{event['LogicalResourceId']} {status}: "
+                    f"{event.get('ResourceStatusReason', '')}"
+                )
+                logger.error(f"waiter({operation}, {stack_id}) {failure}")
+
+        if events:
+            cursor = events[-1]["EventId"]
+
+        # Poll quickly while resources are finishing, back off during long
+        # running creates
+        if events or not pending:
+            interval = MIN_POLL
+        else:
+            interval = min(interval * 2, MAX_POLL)
+
+        if remaining() <= interval:
             raise RuntimeError(
-                f"Stack operation failed: {operation} {status} {stack_id}"
+                f"Timed out waiting for {operation} of {stack_id}, "
+                f"still in progress: {', '.join(sorted(pending))}"
             )
 
-        sleep(randint(1000, 1500) / 100)  # nosec B311
+        sleep(interval)
 
-    logger.info(f"waiter({operation}, {stack_id}) done")
 
+def regional_clients(region=None):
+    return (
+        boto3.client("cloudformation", region_name=region, config=CONFIG),
+        boto3.client("resourcegroupstaggingapi", region_name=region, config=CONFIG),
+    )
 
-def get_stacks(key, value, region=None):
-    cfn_client = boto3.client("cloudformation", region_name=region, config=CONFIG)
-    stacks = []
 
-    for page in cfn_client.get_paginator("describe_stacks").paginate():
-        stacks += page["Stacks"]
-    stack = [stack for stack in stacks if {"Key": key, "Value": value} in stack["Tags"]]
+def find_stack(cfn_client, tagging, key, value):
+    tag = {"Key": key, "Value": value}
 
-    if not len(stack):
+    # Stacks created by put_stack are named after their tag
+    try:
+        stack = cfn_client.describe_stacks(StackName=f"{key}-{value}")["Stacks"][0]
+        if tag in stack.get("Tags", []):
+            return stack
+    except ClientError as e:
+        if "does not exist" not in str(e):
+            raise
+
+    pages = tagging.get_paginator("get_resources").paginate(
+        TagFilters=[{"Key": key, "Values": [value]}],
+        ResourceTypeFilters=["cloudformation:stack"],
+    )
+
+    for page in pages:
+        for resource in page["ResourceTagMappingList"]:
+            stack = cfn_client.describe_stacks(StackName=resource["ResourceARN"])[
+                "Stacks"
+            ][0]
+            if stack["StackStatus"] != "DELETE_COMPLETE":
+                return stack
+
+    return None
+
+
+def get_stacks(key, value, region=None, clients=None):
+    cfn_client, tagging = clients or regional_clients(region)
+    stack = find_stack(cfn_client, tagging, key, value)
+
+    if not stack:
         return None
 
-    stack_id = stack[0]["StackId"]
-    status = stack[0]["StackStatus"]
+    stack_id = stack["StackId"]
+    status = stack["StackStatus"]
 
     if status.endswith("_IN_PROGRESS"):
         operation = status.split("_")[0].lower()
 
-        waiter(cfn_client, operation, stack_id)
+        with metrics.phase("waiter"):
+            waiter(cfn_client, operation, stack_id)
 
         if operation == "delete":
             return None
@@ -63,24 +308,160 @@ def get_stacks(key, value, region=None):
     return stack_id
 
 
-def put_stack(name, region, template_url, parameters, key):
+def region_index(key, name):
+    return f"/{key}/{name}/region"
+
+
+def find_home_region(key, name):
+    # The home region is indexed in SSM in every region that has looked it up,
+    # so only the first lookup per region has to scan the others
+    ssm = boto3.client("ssm", config=CONFIG)
+    try:
+        region = ssm.get_parameter(Name=region_index(key, name))["Parameter"]["Value"]
+        if get_stacks(key, name, region):
+            return region
+
+        logger.info(f"{name} is no longer in {region}, scanning all regions")
+    except ssm.exceptions.ParameterNotFound:
+        logger.info(f"{name} home region not indexed, scanning all regions")
+
+    regions = [
+        r["RegionName"] for r in boto3.client("ec2").describe_regions()["Regions"]
+    ]
+
+    # Clients are created up front as boto3 client creation isn't thread safe
+    clients = {r: regional_clients(r) for r in regions}
+
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    futures = {
+        executor.submit(get_stacks, key, name, r, clients[r]): r for r in regions
+    }
+
+    try:
+        for future in as_completed(futures):
+            if future.result():
+                return futures[future]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return None
+
+
+def index_home_region(key, name, region):
+    ssm = boto3.client("ssm", config=CONFIG)
+    try:
+        current = ssm.get_parameter(Name=region_index(key, name))["Parameter"]["Value"]
+    except ssm.exceptions.ParameterNotFound:
+        current = None
+
+    if current != region:
+        ssm.put_parameter(
+            Name=region_index(key, name), Value=region, Type="String", Overwrite=True
+        )
+
+
+def put_stack(
+    name,
+    region,
+    template_url,
+    parameters,
+    key,
+    version=None,
+    fingerprint_parameter=None,
+):
     logger.info(f"put_stack({name}, {region}, {template_url}, {parameters}, {key})")
 
-    # jitter to reduce the chance of concurrent queries racing
-    sleep(randint(0, 6000) / 100)  # nosec B311
+    # Serializes concurrent stacks deploying the same shared resources. The
+    # lock table is shared by all regions, so regional stacks lock per region.
+    lease = f"{key}/{name}"
+    if name != "AccountSharedResources":
+        lease += f"/{region or boto3.session.Session().region_name}"
+
+    with Lease(lease):
+        _put_stack(
+            name,
+            region,
+            template_url,
+            parameters,
+            key,
+            version,
+            fingerprint_parameter,
+        )
+
+
+def stack_fingerprint(template_url, parameters, version):
+    """Digest of everything a shared stack update would deploy.
+
+    Covers the template's ETag, the ETags of the Lambda packages published
+    next to it, the parameters and the Quick Start version. Buckets that
+    can't be listed fall back to the template, parameters and version.
+    Returns None when the template can't be read, which disables skipping
+    updates.
+    """
+    bucket = template_url.split("https://")[1].split(".")[0]
+    path = template_url.split("/", 3)[3]
+    packages = "/".join(path.split("/")[:-2]) + "/functions/packages/"
+    s3 = boto3.client("s3", config=CONFIG)
+
+    digest = hashlib.sha256(
+        json.dumps([parameters, version], sort_keys=True).encode("utf-8")
+    )
+
+    try:
+        digest.update(s3.head_object(Bucket=bucket, Key=path)["ETag"].encode("utf-8"))
+    except ClientError:
+        logger.warning(f"Unable to read {path} in {bucket}", exc_info=True)
+
+        return None
+
+    try:
+        pages = s3.get_paginator("list_objects_v2").paginate(
+            Bucket=bucket, Prefix=packages
+        )
+        etags = [
+            f"{obj['Key']}={obj['ETag']}"
+            for page in pages
+            for obj in page.get("Contents", [])
+        ]
+    except ClientError as e:
+        logger.warning(
+            f"Unable to list {packages} in {bucket} "
+            f"({e.response['Error']['Code']}), fingerprinting {path} without "
+            "its Lambda packages"
+        )
+        etags = []
+
+    for etag in etags:
+        digest.update(etag.encode("utf-8"))
+
+    return digest.hexdigest()[:32]
+
+
+def _put_stack(
+    name, region, template_url, parameters, key, version, fingerprint_parameter
+):
+    fingerprint = stack_fingerprint(template_url, parameters, version)
+    fingerprint_tag = {"Key": f"{key}-fingerprint", "Value": fingerprint}
+
+    if fingerprint_parameter:
+        parameters = {**parameters, fingerprint_parameter: fingerprint or uuid4().hex}
 
     if name == "AccountSharedResources":
-        for r in [
-            r["RegionName"] for r in boto3.client("ec2").describe_regions()["Regions"]
-        ]:
-            acc_stack = get_stacks(key, name, r)
-            if acc_stack:
-                region = r
-                break
+        region = find_home_region(key, name) or region
 
     stack_id = get_stacks(key, name, region)
     client = boto3.client("cloudformation", region_name=region)
 
+    if name == "AccountSharedResources":
+        index_home_region(key, name, client.meta.region_name)
+
+    if stack_id and fingerprint:
+        stack = client.describe_stacks(StackName=stack_id)["Stacks"][0]
+        if fingerprint_tag in stack.get("Tags", []):
+            logger.info(f"{name} is up to date with {fingerprint}, skipping update")
+
+            return
+
     args = {
         "StackName": stack_id if stack_id else f"{key}-{name}",
         "TemplateURL": template_url,
@@ -96,6 +477,9 @@ def put_stack(name, region, template_url, parameters, key):
         "Tags": [{"Key": key, "Value": name}],
     }
 
+    if fingerprint:
+        args["Tags"].append(fingerprint_tag)
+
     method = client.create_stack
 
     wait = "create"
@@ -113,12 +497,15 @@ def put_stack(name, region, template_url, parameters, key):
         logger.exception("Error getting stack ID")
         raise
 
-    waiter(client, wait, stack_id)
+    with metrics.phase("waiter"):
+        waiter(client, wait, stack_id)
 
 
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    metrics.set_dimensions(RequestType=event.get("RequestType", ""))
+    set_deadline(context)
 
     logger.debug(json.dumps(event))
 
@@ -131,30 +518,33 @@ def handler(event, context):
 
     try:
         if event["RequestType"] != "Delete":
-            retries = 10
+            backoff = Backoff(context, base=2, attempts=10)
             while True:
-                retries -= 1
-
                 try:
-                    put_stack("AccountSharedResources", None, acc_uri, {}, key)
+                    put_stack(
+                        "AccountSharedResources",
+                        None,
+                        acc_uri,
+                        {},
+                        key,
+                        props.get("Version"),
+                    )
+                    # RandomStr forces new layer versions, so it only changes
+                    # along with the fingerprint
                     put_stack(
                         "RegionalSharedResources",
                         None,
                         props["RegionalTemplateUri"],
-                        {
-                            "QSS3BucketName": bucket,
-                            "QSS3KeyPrefix": prefix,
-                            "RandomStr": uuid4().hex,
-                        },
+                        {"QSS3BucketName": bucket, "QSS3KeyPrefix": prefix},
                         key,
+                        props.get("Version"),
+                        fingerprint_parameter="RandomStr",
                     )
                     break
                 except Exception:
                     logger.exception("Error executing put_stack")
 
-                    if retries > 0:
-                        sleep(randint(0, 3000) / 100)  # nosec B311
-                    else:
+                    if not backoff.wait():
                         raise
     except Exception:
         status = cfnresponse.FAILED
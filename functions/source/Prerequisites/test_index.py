@@ -0,0 +1,102 @@
+import os
+import sys
+from time import time
+from types import SimpleNamespace
+
+import boto3
+import pytest
+from moto import mock_aws
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../QuickStartUtilsLayer"))
+
+import index  # noqa: E402
+from quickstart_utils import retry  # noqa: E402
+
+
+@pytest.fixture
+def table(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+
+    with mock_aws():
+        client = boto3.client("dynamodb", region_name=index.DEFAULT_LOCK_REGION)
+        client.create_table(
+            TableName=index.LOCK_TABLE,
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        yield client
+
+
+@pytest.fixture
+def deadline():
+    # Bounds the waits of a contended lease to about a second
+    def set_deadline(seconds):
+        context = SimpleNamespace(
+            get_remaining_time_in_millis=lambda: (seconds + retry.RESPONSE_BUFFER)
+            * 1000
+        )
+        retry.set_deadline(context)
+
+    yield set_deadline
+    retry._invocation["deadline"] = None
+
+
+def lease_item(client, name):
+    return client.get_item(TableName=index.LOCK_TABLE, Key={"id": {"S": name}}).get(
+        "Item"
+    )
+
+
+def test_lease_acquires_and_releases(table):
+    with index.Lease("key/AccountSharedResources") as lease:
+        assert lease.held
+        item = lease_item(table, "key/AccountSharedResources")
+        assert item["owner"]["S"] == lease.owner
+        assert int(item["expires"]["N"]) > time()
+
+    assert lease_item(table, "key/AccountSharedResources") is None
+
+
+def test_lease_contended(table, deadline):
+    deadline(1)
+
+    with index.Lease("key/AccountSharedResources"):
+        with pytest.raises(RuntimeError, match="Timed out waiting for lock"):
+            with index.Lease("key/AccountSharedResources"):
+                pass
+
+        # Other names aren't blocked
+        with index.Lease("key/RegionalSharedResources/eu-west-1") as other:
+            assert other.held
+
+
+def test_lease_expired(table):
+    table.put_item(
+        TableName=index.LOCK_TABLE,
+        Item={
+            "id": {"S": "key/AccountSharedResources"},
+            "owner": {"S": "crashed"},
+            "expires": {"N": str(int(time()) - 1)},
+        },
+    )
+
+    with index.Lease("key/AccountSharedResources") as lease:
+        assert lease.held
+        item = lease_item(table, "key/AccountSharedResources")
+        assert item["owner"]["S"] == lease.owner
+
+
+def test_lease_without_table(table, monkeypatch):
+    table.delete_table(TableName=index.LOCK_TABLE)
+    delays = []
+    monkeypatch.setattr(index, "sleep", delays.append)
+
+    with index.Lease("key/AccountSharedResources") as lease:
+        assert not lease.held
+
+    assert len(delays) == 1 and 0 <= delays[0] <= 60
@@ -4,6 +4,9 @@ import logging
 import re
 from functools import partial
 
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.profiler import maybe_profile
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,12 +46,20 @@ def param_resolve(params, match):
     return params[match.group()[1:-1]]
 
 
-def handler(event, _):
+def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
 
     logger.debug(json.dumps(event))
 
+    # Macros have no resource properties, so the switch is a transform parameter
+    with maybe_profile(
+        event.get("params", {}), f"QuickStartParameterResolver-{context.aws_request_id}"
+    ):
+        return resolve(event)
+
+
+def resolve(event):
     macro_response = {"requestId": event["requestId"], "status": "success"}
 
     try:
@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+from base64 import b64decode, urlsafe_b64encode
+from time import time
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PREFIX = "k8s-aws-v1."
+TOKEN_LIFETIME = 15 * 60  # seconds
+TOKEN_REFRESH = 60  # seconds before expiry at which a new token is generated
+
+# Kept for the life of the container, so warm invocations skip cluster setup
+clusters = {}
+kubeconfig = {}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def client(name: str):
+    """Returns a client shared by the module, created on first use.
+
+    Creation is serialized as boto3 client creation isn't thread safe.
+    """
+    with _lock:
+        if not _clients:
+            _clients["session"] = boto3.session.Session()
+
+        if name not in _clients:
+            _clients[name] = _clients["session"].client(name)
+
+            if name == "sts":
+                _register_cluster_id(_clients[name])
+
+        return _clients[name]
+
+
+def _register_cluster_id(sts_client):
+    # GetCallerIdentity takes no x-k8s-aws-id parameter, so it's carried in the
+    # request context and added as a signed header, as `aws eks get-token` does.
+    def provide_cluster_id(params, context, **_):
+        if "x-k8s-aws-id" in params:
+            context["x-k8s-aws-id"] = params.pop("x-k8s-aws-id")
+
+    def inject_cluster_id(request, **_):
+        if "x-k8s-aws-id" in request.context:
+            request.headers["x-k8s-aws-id"] = request.context["x-k8s-aws-id"]
+
+    events = sts_client.meta.events
+    events.register("provide-client-params.sts.GetCallerIdentity", provide_cluster_id)
+    events.register("before-sign.sts.GetCallerIdentity", inject_cluster_id)
+
+
+def get_token(cluster_name: str):
+    # Same token format as `aws eks get-token`: a presigned sts:GetCallerIdentity
+    # url, bound to the cluster through the x-k8s-aws-id header. Presigning
+    # through the client keeps the signing region in step with the endpoint
+    # the client resolved, including the global one.
+    url = client("sts").generate_presigned_url(
+        "get_caller_identity",
+        Params={"x-k8s-aws-id": cluster_name},
+        ExpiresIn=60,
+        HttpMethod="GET",
+    )
+
+    token = urlsafe_b64encode(url.encode("utf-8")).decode("utf-8")
+
+    return TOKEN_PREFIX + token.rstrip("=")
+
+
+def get_cluster(cluster_name: str):
+    cluster = clusters.get(cluster_name)
+
+    if cluster and time() < cluster["expires"]:
+        logger.info(f"Cluster cache hit for {cluster_name}")
+
+        return cluster
+
+    if cluster:
+        logger.info(f"Cluster cache miss for {cluster_name}, token expiring")
+    else:
+        logger.info(f"Cluster cache miss for {cluster_name}")
+        response = client("eks").describe_cluster(name=cluster_name)["cluster"]
+        ca_file = f"/tmp/{cluster_name}-ca.crt"  # nosec B108
+
+        with open(ca_file, "wb") as f:
+            f.write(b64decode(response["certificateAuthority"]["data"]))
+
+        cluster = {"endpoint": response["endpoint"], "ca_file": ca_file}
+
+    cluster["token"] = get_token(cluster_name)
+    cluster["expires"] = time() + TOKEN_LIFETIME - TOKEN_REFRESH
+    clusters[cluster_name] = cluster
+
+    return cluster
+
+
+def create_kubeconfig(cluster_name: str):
+    # Writes a kubeconfig with a static token rather than an exec credential
+    # plugin, so kubectl calls don't fork `aws eks get-token` either.
+    cluster = get_cluster(cluster_name)
+
+    if kubeconfig.get(cluster_name) != cluster["token"]:
+        path = os.path.expanduser(os.environ.get("KUBECONFIG", "~/.kube/config"))
+        config = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [
+                {
+                    "name": cluster_name,
+                    "cluster": {
+                        "server": cluster["endpoint"],
+                        "certificate-authority": cluster["ca_file"],
+                    },
+                }
+            ],
+            "users": [{"name": cluster_name, "user": {"token": cluster["token"]}}],
+            "contexts": [
+                {
+                    "name": cluster_name,
+                    "context": {"cluster": cluster_name, "user": cluster_name},
+                }
+            ],
+            "current-context": cluster_name,
+        }
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(json.dumps(config))
+        kubeconfig.clear()
+        kubeconfig[cluster_name] = cluster["token"]
+
+    return cluster["expires"]
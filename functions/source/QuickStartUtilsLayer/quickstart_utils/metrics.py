@@ -0,0 +1,55 @@
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+
+NAMESPACE = "EKSQuickStart"
+
+
+class Metrics:
+    """Emits phase timings as CloudWatch Embedded Metric Format log lines.
+
+    Each phase is written as soon as it completes, so timings survive an
+    invocation that later times out. Output goes to stdout, where Lambda
+    hands it to CloudWatch Logs, unless another stream is given.
+    """
+
+    def __init__(self, function_name: str, namespace: str = NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+        self.dimensions = {"Function": function_name}
+        self.lock = threading.Lock()
+
+    def set_dimensions(self, **dimensions):
+        self.dimensions.update({k: str(v) for k, v in dimensions.items()})
+
+    def put(self, name: str, value: float, unit: str = "Milliseconds"):
+        line = {
+            "_aws": {
+                "Timestamp": int(time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [list(self.dimensions.keys())],
+                        "Metrics": [{"Name": name, "Unit": unit}],
+                    }
+                ],
+            },
+            name: value,
+        }
+        line.update(self.dimensions)
+
+        with self.lock:
+            stream = self.stream or sys.stdout
+            stream.write(json.dumps(line) + "\n")
+            stream.flush()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.put(name, round((perf_counter() - start) * 1000, 3))
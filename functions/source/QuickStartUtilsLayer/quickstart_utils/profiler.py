@@ -0,0 +1,155 @@
+import cProfile
+import io
+import logging
+import marshal
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import strftime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DESTINATION = "/tmp/profiles"
+DEFAULT_INTERVAL = 0.005
+FORMATS = ("collapsed", "pstats")
+
+
+def enabled(value) -> bool:
+    # CloudFormation passes every resource property through as a string
+    return str(value).lower() in ("true", "1", "yes")
+
+
+class Sampler:
+    """Samples the stack of one thread from a background thread.
+
+    Stacks are aggregated in the collapsed format understood by
+    flamegraph.pl and speedscope, so the cost per sample is a frame walk
+    and a counter increment regardless of how deep the profiled code goes.
+    """
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.target = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        frame = sys._current_frames().get(self.target)
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            filename = os.path.basename(code.co_filename)
+            stack.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+            frame = frame.f_back
+
+        if stack:
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self) -> bytes:
+        lines = [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+        return ("\n".join(lines) + "\n").encode()
+
+
+class Tracer:
+    """Deterministic cProfile run, for when exact call counts matter more
+    than overhead."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self) -> bytes:
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)
+
+
+def write(data: bytes, destination: str, name: str) -> str:
+    """Writes a profile to a local directory or an s3://bucket/prefix."""
+    if destination.startswith("s3://"):
+        import boto3
+
+        bucket, _, prefix = destination[len("s3://") :].partition("/")
+        key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+        boto3.client("s3").upload_fileobj(io.BytesIO(data), bucket, key)
+        return f"s3://{bucket}/{key}"
+
+    os.makedirs(destination, exist_ok=True)
+    path = os.path.join(destination, name)
+
+    with open(path, "wb") as f:
+        f.write(data)
+
+    return path
+
+
+@contextmanager
+def profile(
+    name: str,
+    destination: str = None,
+    fmt: str = "collapsed",
+    interval: float = DEFAULT_INTERVAL,
+):
+    """Profiles the enclosed block and writes the result on exit.
+
+    ``fmt`` is "collapsed" for sampled stacks ready for a flame graph, or
+    "pstats" for a cProfile dump loadable with pstats.Stats. Failing to
+    write the profile is logged and never masks the profiled outcome.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported profile format {fmt}, use one of {FORMATS}")
+
+    profiler = Sampler(interval) if fmt == "collapsed" else Tracer()
+    profiler.start()
+
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        filename = f"{name}-{strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.{fmt}"
+
+        try:
+            location = write(
+                profiler.dump(), destination or DEFAULT_DESTINATION, filename
+            )
+            logger.info(f"Wrote {fmt} profile to {location}")
+        except Exception:
+            logger.exception("Failed to write profile")
+
+
+@contextmanager
+def maybe_profile(properties: dict, name: str):
+    """Profiles the enclosed block when ``Profile`` is set in properties.
+
+    ``ProfileDestination`` and ``ProfileFormat`` select where and how the
+    result is written; see profile().
+    """
+    if not enabled(properties.get("Profile", False)):
+        yield None
+        return
+
+    with profile(
+        name,
+        properties.get("ProfileDestination"),
+        properties.get("ProfileFormat", "collapsed"),
+    ) as profiler:
+        yield profiler
@@ -0,0 +1,143 @@
+import logging
+from random import uniform
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+# Seconds kept back from the Lambda timeout to send the CloudFormation response
+RESPONSE_BUFFER = 10
+
+THROTTLING_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "RequestThrottled",
+    "SlowDown",
+)
+
+_invocation = {"deadline": None}
+
+
+def set_deadline(context, buffer: float = RESPONSE_BUFFER):
+    """Records when the current invocation must give up retrying.
+
+    Handlers call this first so that backoffs created deep in helper code,
+    without access to the Lambda context, still respect the timeout.
+    """
+    remaining = context.get_remaining_time_in_millis() / 1000 - buffer
+    _invocation["deadline"] = monotonic() + remaining
+
+
+def remaining() -> float:
+    """Seconds left in the current invocation, or infinity outside Lambda."""
+    if _invocation["deadline"] is None:
+        return float("inf")
+
+    return _invocation["deadline"] - monotonic()
+
+
+class Backoff:
+    """Exponential backoff with full jitter, bounded by a deadline.
+
+    Each wait() sleeps a random time between 0 and min(cap, base * 2 ** n),
+    clipped to the time remaining, and returns False once the attempts or
+    the deadline are used up. Without an explicit context or timeout the
+    invocation deadline from set_deadline() applies.
+    """
+
+    def __init__(
+        self,
+        context=None,
+        timeout: float = None,
+        base: float = 1,
+        cap: float = 30,
+        attempts: int = None,
+        buffer: float = RESPONSE_BUFFER,
+    ):
+        if context is not None:
+            timeout = context.get_remaining_time_in_millis() / 1000 - buffer
+
+        self.deadline = monotonic() + timeout if timeout is not None else None
+        self.base = base
+        self.cap = cap
+        self.attempts = attempts
+        self.attempt = 0
+
+    def reset(self):
+        """Restarts the delays from base, keeping the deadline."""
+        self.attempt = 0
+
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return remaining()
+
+        return min(self.deadline - monotonic(), remaining())
+
+    def delay(self) -> float:
+        return uniform(0, min(self.cap, self.base * 2**self.attempt))  # nosec B311
+
+    def wait(self) -> bool:
+        self.attempt += 1
+
+        if self.attempts is not None and self.attempt >= self.attempts:
+            return False
+
+        left = self.remaining()
+        if left <= 0:
+            return False
+
+        sleep(min(self.delay(), left))
+
+        return True
+
+
+def retryable(*types, messages=(), codes=()):
+    """Builds a predicate matching exceptions by class, message or error code.
+
+    ``messages`` match substrings of str(e) and ``codes`` match the error
+    code of a botocore ClientError. With no arguments every exception
+    matches.
+    """
+
+    def predicate(e: Exception) -> bool:
+        if not (types or messages or codes):
+            return True
+
+        if types and isinstance(e, types):
+            return True
+
+        if any(m in str(e) for m in messages):
+            return True
+
+        response = getattr(e, "response", None)
+        if not isinstance(response, dict):
+            return False
+
+        return response.get("Error", {}).get("Code") in codes
+
+    return predicate
+
+
+throttled = retryable(codes=THROTTLING_CODES)
+
+
+def retry(func, *args, when=retryable(), backoff: Backoff = None, **kwargs):
+    """Calls func until it succeeds, retrying errors matched by ``when``.
+
+    The last error is re-raised once the backoff is exhausted.
+    """
+    backoff = backoff or Backoff()
+
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not when(e):
+                raise
+
+            logger.info(f"{getattr(func, '__name__', func)} failed: {e}")
+
+            if not backoff.wait():
+                raise
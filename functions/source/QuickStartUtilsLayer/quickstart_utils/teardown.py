@@ -0,0 +1,528 @@
+import argparse
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from .retry import Backoff, retry, retryable
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 8
+DESCRIBE_BATCH = 200  # filter values allowed per describe call
+RELEASE_TIMEOUT = 300
+SG_DELETE_TIMEOUT = 120
+
+# Hyperplane ENIs are described as "AWS Lambda VPC ENI-<function>-<uuid>"
+LAMBDA_ENI = re.compile(
+    r"^AWS Lambda VPC ENI-(?P<name>.+?)"
+    r"(-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})?$"
+)
+# Load balancer ENIs are described as "ELB <name>" for classic and
+# "ELB <app|net|gwy>/<name>/<id>" for v2 load balancers
+LB_ENI_PREFIX = "ELB "
+
+NOT_FOUND_CODES = (
+    "InvalidGroup.NotFound",
+    "InvalidNetworkInterfaceID.NotFound",
+    "InvalidAttachmentID.NotFound",
+    "LoadBalancerNotFound",
+    "ResourceNotFoundException",
+)
+
+
+def not_found(e: Exception) -> bool:
+    return retryable(codes=NOT_FOUND_CODES)(e)
+
+
+def batches(values, size: int = DESCRIBE_BATCH):
+    values = sorted(values)
+    return [values[pos : pos + size] for pos in range(0, len(values), size)]
+
+
+def key_name(key: tuple) -> str:
+    return " ".join(key)
+
+
+def cluster_tags(cluster_name: str) -> list:
+    return [
+        {"Key": f"kubernetes.io/cluster/{cluster_name}", "Values": ["owned"]},
+        {"Key": "elbv2.k8s.aws/cluster", "Values": [cluster_name]},
+    ]
+
+
+def lambda_function(description: str):
+    """Returns the function named by a Lambda ENI description, or None."""
+    match = LAMBDA_ENI.match(description)
+    return match.group("name") if match else None
+
+
+def eni_description(lb: str) -> str:
+    """Description of the ENIs of a classic load balancer name or v2 ARN."""
+    return LB_ENI_PREFIX + lb.split(":loadbalancer/")[-1]
+
+
+def tagged_load_balancers(tagging, cluster_name: str) -> dict:
+    """Looks the cluster's load balancers up through the Resource Groups
+    Tagging API, instead of reading the tags of every load balancer in the
+    region.
+
+    Returns classic load balancer names and v2 load balancer ARNs keyed by
+    client.
+    """
+    found = {"elb": set(), "elbv2": set()}
+    paginator = tagging.get_paginator("get_resources")
+
+    # Tag filters in one request are ANDed, so each tag is its own query
+    for tag in cluster_tags(cluster_name):
+        for page in paginator.paginate(
+            ResourceTypeFilters=["elasticloadbalancing:loadbalancer"],
+            TagFilters=[tag],
+        ):
+            for r in page["ResourceTagMappingList"]:
+                # loadbalancer/<name> for classic,
+                # loadbalancer/<app|net|gwy>/<name>/<id> for v2
+                path = r["ResourceARN"].split(":", 5)[5].split("/")
+                if len(path) == 2:
+                    found["elb"].add(path[1])
+                else:
+                    found["elbv2"].add(r["ResourceARN"])
+
+    return found
+
+
+def reference_index(ec2, sg_ids) -> dict:
+    """Finds every rule that references any of sg_ids, in any group.
+
+    Returns the rules keyed by (referencing group, direction), each trimmed
+    to the group pairs naming sg_ids so unrelated sources stay in place.
+    """
+    index = {}
+    paginator = ec2.get_paginator("describe_security_groups")
+
+    for direction, name, key in [
+        ("ingress", "ip-permission.group-id", "IpPermissions"),
+        ("egress", "egress.ip-permission.group-id", "IpPermissionsEgress"),
+    ]:
+        for batch in batches(sg_ids):
+            for page in paginator.paginate(Filters=[{"Name": name, "Values": batch}]):
+                for sg in page["SecurityGroups"]:
+                    for p in sg[key]:
+                        pairs = [
+                            x
+                            for x in p.get("UserIdGroupPairs", [])
+                            if x["GroupId"] in sg_ids
+                        ]
+                        if not pairs:
+                            continue
+
+                        rule = {
+                            k: p[k]
+                            for k in ["IpProtocol", "FromPort", "ToPort"]
+                            if k in p
+                        }
+                        rule["UserIdGroupPairs"] = pairs
+                        rules = index.setdefault((sg["GroupId"], direction), [])
+                        if rule not in rules:
+                            rules.append(rule)
+
+    return index
+
+
+class Step:
+    """One action of a teardown plan.
+
+    ``calls`` is the number of API calls the action is expected to make,
+    counting a single poll for actions that wait.
+    """
+
+    def __init__(self, key: tuple, action, calls: int = 1, after=()):
+        self.key = key
+        self.action = action
+        self.calls = calls
+        self.after = set(after)
+
+
+class Plan:
+    """A deletion DAG, executed level by level.
+
+    Every step of a level only depends on steps of earlier levels, so the
+    steps inside a level run in parallel.
+    """
+
+    def __init__(self, collect_calls: int = 0):
+        self.steps = {}
+        self.collect_calls = collect_calls
+
+    def add(self, key: tuple, action, calls: int = 1, after=()):
+        self.steps[key] = Step(key, action, calls, after)
+
+    def levels(self) -> list:
+        # Dependencies on steps that aren't in the plan are already satisfied
+        pending = {
+            key: step.after & self.steps.keys() for key, step in self.steps.items()
+        }
+        levels = []
+
+        while pending:
+            ready = sorted(key for key, after in pending.items() if not after)
+            if not ready:
+                cycle = ", ".join(key_name(key) for key in sorted(pending))
+                raise ValueError(f"Dependency cycle between {cycle}")
+
+            levels.append(ready)
+            for key in ready:
+                del pending[key]
+            for after in pending.values():
+                after.difference_update(ready)
+
+        return levels
+
+    def api_calls(self) -> int:
+        return sum(step.calls for step in self.steps.values())
+
+    def describe(self) -> str:
+        lines = []
+
+        for n, level in enumerate(self.levels()):
+            lines.append(f"Level {n}:")
+            for key in level:
+                after = sorted(self.steps[key].after & self.steps.keys())
+                suffix = f" (after {', '.join(map(key_name, after))})" if after else ""
+                lines.append(f"  {key_name(key)}{suffix}")
+
+        lines.append(
+            f"{len(self.steps)} steps, about {self.api_calls()} API calls to "
+            f"execute ({self.collect_calls} made collecting)"
+        )
+
+        return "\n".join(lines)
+
+    def execute(self, workers: int = MAX_WORKERS) -> set:
+        """Runs every level's steps in parallel, one level after another.
+
+        A failed step is logged and the steps depending on it are skipped.
+        Returns the keys of the failed and skipped steps.
+        """
+        failed = set()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for level in self.levels():
+                futures = {}
+                for key in level:
+                    if self.steps[key].after & failed:
+                        logger.warning(f"Skipping {key_name(key)}")
+                        failed.add(key)
+                    else:
+                        futures[key] = executor.submit(self.steps[key].action)
+
+                for key, future in futures.items():
+                    try:
+                        future.result()
+                    except Exception:
+                        logger.exception(f"ERROR: {key_name(key)} failed")
+                        failed.add(key)
+
+        return failed
+
+
+class Teardown:
+    """Collects what is left of a cluster in one pass and plans its deletion.
+
+    The plan covers the cluster's load balancers, its security groups and
+    any extra ones given, the rules in other groups referencing them, the
+    ENIs using them and the VPC Lambda functions owning some of those ENIs.
+    """
+
+    def __init__(self, session=None):
+        session = session or boto3.session.Session()
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.clients = {}
+
+        # Clients are created up front as boto3 client creation isn't thread safe
+        for name in ["ec2", "elb", "elbv2", "lambda", "resourcegroupstaggingapi"]:
+            client = session.client(name)
+            client.meta.events.register("before-call", self.count)
+            self.clients[name] = client
+
+        self.ec2 = self.clients["ec2"]
+        self.functions = {}
+
+    def count(self, **_):
+        with self.lock:
+            self.calls += 1
+
+    def security_groups(self, cluster_name: str) -> set:
+        sg_ids = set()
+        paginator = self.ec2.get_paginator("describe_security_groups")
+
+        for tag in cluster_tags(cluster_name):
+            filters = [{"Name": f"tag:{tag['Key']}", "Values": tag["Values"]}]
+            for page in paginator.paginate(Filters=filters):
+                sg_ids.update(sg["GroupId"] for sg in page["SecurityGroups"])
+
+        return sg_ids
+
+    def network_interfaces(self, sg_ids: set) -> list:
+        enis = {}
+        paginator = self.ec2.get_paginator("describe_network_interfaces")
+
+        for batch in batches(sg_ids):
+            for page in paginator.paginate(
+                Filters=[{"Name": "group-id", "Values": batch}]
+            ):
+                for eni in page["NetworkInterfaces"]:
+                    enis[eni["NetworkInterfaceId"]] = eni
+
+        return list(enis.values())
+
+    def vpc_function(self, eni: dict, sg_ids: set):
+        """Returns the name of the VPC Lambda function owning eni, if it
+        still exists and still uses one of sg_ids."""
+        name = lambda_function(eni.get("Description", ""))
+        if name is None:
+            return None
+
+        if name not in self.functions:
+            try:
+                config = self.clients["lambda"].get_function_configuration(
+                    FunctionName=name
+                )
+                groups = config.get("VpcConfig", {}).get("SecurityGroupIds", [])
+            except Exception as e:
+                if not not_found(e):
+                    raise
+                groups = []
+
+            self.functions[name] = set(groups)
+
+        return name if sg_ids & self.functions[name] else None
+
+    def plan(self, cluster_name: str, security_group_ids=()) -> Plan:
+        start = self.calls
+
+        lbs = tagged_load_balancers(
+            self.clients["resourcegroupstaggingapi"], cluster_name
+        )
+        sg_ids = self.security_groups(cluster_name) | set(security_group_ids)
+        index = reference_index(self.ec2, sg_ids) if sg_ids else {}
+        enis = self.network_interfaces(sg_ids) if sg_ids else []
+
+        plan = Plan()
+        lb_keys = {}
+        for client_name, identifiers in lbs.items():
+            for lb in identifiers:
+                key = ("delete_load_balancer", lb)
+                lb_keys[eni_description(lb)] = key
+                plan.add(key, self.delete_load_balancer(client_name, lb))
+
+        after_sg = {sg_id: set() for sg_id in sg_ids}
+
+        for (group_id, direction), rules in index.items():
+            key = (f"revoke_{direction}", group_id)
+            plan.add(key, self.revoke(group_id, direction, rules))
+            for rule in rules:
+                for pair in rule["UserIdGroupPairs"]:
+                    after_sg[pair["GroupId"]].add(key)
+
+        # ENIs that go away with their owner are waited for in one batch
+        released, owners = [], set()
+        for eni in enis:
+            eni_id = eni["NetworkInterfaceId"]
+            description = eni.get("Description", "")
+            function = self.vpc_function(eni, sg_ids)
+
+            if function:
+                owner = ("delete_function", function)
+                plan.add(owner, self.delete_function(function))
+                owners.add(owner)
+            elif description.startswith(LB_ENI_PREFIX):
+                owner = lb_keys.get(description)
+                if owner is None:
+                    logger.warning(
+                        f"{eni_id} belongs to another load balancer: {description}"
+                    )
+                    continue
+                owners.add(owner)
+            elif lambda_function(description) or eni.get("RequesterManaged"):
+                # EC2 refuses to detach or delete requester-managed ENIs, such
+                # as those of functions that are already gone, so only wait
+                pass
+            else:
+                key = ("delete_network_interface", eni_id)
+                calls = 3 if eni.get("Attachment") else 1
+                plan.add(key, self.delete_eni(eni), calls)
+                for group in eni["Groups"]:
+                    after_sg.get(group["GroupId"], set()).add(key)
+                continue
+
+            released.append(eni_id)
+            for group in eni["Groups"]:
+                after_sg.get(group["GroupId"], set()).add(("wait_released", "enis"))
+
+        if released:
+            plan.add(
+                ("wait_released", "enis"),
+                self.wait_released(released),
+                len(batches(released)),
+                owners,
+            )
+
+        for sg_id, after in after_sg.items():
+            plan.add(("delete_security_group", sg_id), self.delete_sg(sg_id), 1, after)
+
+        plan.collect_calls = self.calls - start
+
+        return plan
+
+    def delete_load_balancer(self, client_name: str, lb: str):
+        client = self.clients[client_name]
+        key = "LoadBalancerName" if client_name == "elb" else "LoadBalancerArn"
+
+        def action():
+            try:
+                client.delete_load_balancer(**{key: lb})
+            except Exception as e:
+                if not not_found(e):
+                    raise
+
+        return action
+
+    def delete_function(self, name: str):
+        def action():
+            try:
+                self.clients["lambda"].delete_function(FunctionName=name)
+            except Exception as e:
+                if not not_found(e):
+                    raise
+
+        return action
+
+    def revoke(self, group_id: str, direction: str, rules: list):
+        revoke = {
+            "ingress": self.ec2.revoke_security_group_ingress,
+            "egress": self.ec2.revoke_security_group_egress,
+        }[direction]
+
+        def action():
+            try:
+                revoke(GroupId=group_id, IpPermissions=rules)
+            except Exception as e:
+                if not not_found(e):
+                    raise
+
+        return action
+
+    def delete_eni(self, eni: dict):
+        eni_id = eni["NetworkInterfaceId"]
+        attachment_id = eni.get("Attachment", {}).get("AttachmentId")
+
+        def action():
+            try:
+                if attachment_id:
+                    self.ec2.detach_network_interface(
+                        AttachmentId=attachment_id, Force=True
+                    )
+                    self.wait_available(eni_id)
+                self.ec2.delete_network_interface(NetworkInterfaceId=eni_id)
+            except Exception as e:
+                if not not_found(e):
+                    raise
+
+        return action
+
+    def wait_available(self, eni_id: str):
+        backoff = Backoff(timeout=RELEASE_TIMEOUT, base=1, cap=5)
+        filters = [{"Name": "network-interface-id", "Values": [eni_id]}]
+
+        while True:
+            enis = self.ec2.describe_network_interfaces(Filters=filters)
+            if all(e["Status"] == "available" for e in enis["NetworkInterfaces"]):
+                return
+
+            if not backoff.wait():
+                raise TimeoutError(f"{eni_id} is still attached")
+
+    def wait_released(self, eni_ids: list):
+        def action():
+            backoff = Backoff(timeout=RELEASE_TIMEOUT, base=2, cap=15)
+            pending = eni_ids
+
+            while True:
+                found = []
+                for batch in batches(pending):
+                    filters = [{"Name": "network-interface-id", "Values": batch}]
+                    enis = self.ec2.describe_network_interfaces(Filters=filters)
+                    found += [
+                        e["NetworkInterfaceId"] for e in enis["NetworkInterfaces"]
+                    ]
+
+                pending = found
+                if not pending:
+                    return
+
+                logger.info(f"Waiting for {', '.join(pending)} to be released")
+                if not backoff.wait():
+                    raise TimeoutError(f"{', '.join(pending)} still in use")
+
+        return action
+
+    def delete_sg(self, sg_id: str):
+        def action():
+            try:
+                retry(
+                    self.ec2.delete_security_group,
+                    GroupId=sg_id,
+                    when=retryable(codes=("DependencyViolation",)),
+                    backoff=Backoff(timeout=SG_DELETE_TIMEOUT, base=2, cap=15),
+                )
+            except Exception as e:
+                if not not_found(e):
+                    raise
+
+        return action
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Deletes what an EKS cluster leaves behind in its VPC."
+    )
+    parser.add_argument("cluster_name")
+    parser.add_argument(
+        "--security-group",
+        action="append",
+        default=[],
+        help="Another security group to delete along with its dependencies",
+    )
+    parser.add_argument("--region")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Print the plan without executing it"
+    )
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+
+    teardown = Teardown(boto3.session.Session(region_name=args.region))
+    plan = teardown.plan(args.cluster_name, args.security_group)
+    print(plan.describe())
+
+    if args.dry_run:
+        return 0
+
+    start = teardown.calls
+    failed = plan.execute(args.workers)
+    print(f"Executed with {teardown.calls - start} API calls")
+
+    if failed:
+        print(f"Failed: {', '.join(map(key_name, sorted(failed)))}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
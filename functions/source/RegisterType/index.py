@@ -4,10 +4,12 @@ import json
 
 # Provided through CrhelperLayer in amazon-eks-per-region-resources.template.yaml
 from crhelper import CfnResource
-from random import choice
 from semantic_version import Version
 from time import sleep
 
+# Provided through QuickStartUtilsLayer in amazon-eks-per-region-resources.template.yaml
+from quickstart_utils.retry import Backoff, retry, set_deadline
+
 execution_trust_policy = {
     "Version": "2012-10-17",
     "Statement": [
@@ -69,68 +71,63 @@ partition = identity["Arn"].split(":")[1]
 
 
 def put_role(role_name, policy, trust_policy):
-    retries = 5
-    while True:
-        try:
-            try:
-                response = iam.create_role(
-                    Path="/",
-                    RoleName=role_name,
-                    AssumeRolePolicyDocument=json.dumps(trust_policy),
-                )
-                role_arn = response["Role"]["Arn"]
-            except iam.exceptions.EntityAlreadyExistsException:
-                role_arn = f"arn:{partition}:iam::{account_id}:role/{role_name}"
+    return retry(
+        _put_role,
+        role_name,
+        policy,
+        trust_policy,
+        backoff=Backoff(attempts=5, cap=10),
+    )
+
+
+def _put_role(role_name, policy, trust_policy):
+    try:
+        response = iam.create_role(
+            Path="/",
+            RoleName=role_name,
+            AssumeRolePolicyDocument=json.dumps(trust_policy),
+        )
+        role_arn = response["Role"]["Arn"]
+    except iam.exceptions.EntityAlreadyExistsException:
+        role_arn = f"arn:{partition}:iam::{account_id}:role/{role_name}"
+
+    try:
+        response = iam.create_policy(
+            Path="/", PolicyName=role_name, PolicyDocument=json.dumps(policy)
+        )
+        arn = response["Policy"]["Arn"]
+    except iam.exceptions.EntityAlreadyExistsException:
+        arn = f"arn:{partition}:iam::{account_id}:policy/{role_name}"
+        versions = iam.list_policy_versions(PolicyArn=arn)["Versions"]
+
+        if len(versions) >= 5:
+            oldest = [v for v in versions if not v["IsDefaultVersion"]][-1]["VersionId"]
+            iam.delete_policy_version(PolicyArn=arn, VersionId=oldest)
 
+        while True:
             try:
-                response = iam.create_policy(
-                    Path="/", PolicyName=role_name, PolicyDocument=json.dumps(policy)
+                iam.create_policy_version(
+                    PolicyArn=arn,
+                    PolicyDocument=json.dumps(policy),
+                    SetAsDefault=True,
                 )
-                arn = response["Policy"]["Arn"]
-            except iam.exceptions.EntityAlreadyExistsException:
-                arn = f"arn:{partition}:iam::{account_id}:policy/{role_name}"
-                versions = iam.list_policy_versions(PolicyArn=arn)["Versions"]
 
-                if len(versions) >= 5:
+                break
+            except Exception as e:
+                if "you must delete an existing version" in str(e):
+                    versions = iam.list_policy_versions(PolicyArn=arn)["Versions"]
                     oldest = [v for v in versions if not v["IsDefaultVersion"]][-1][
                         "VersionId"
                     ]
                     iam.delete_policy_version(PolicyArn=arn, VersionId=oldest)
 
-                while True:
-                    try:
-                        iam.create_policy_version(
-                            PolicyArn=arn,
-                            PolicyDocument=json.dumps(policy),
-                            SetAsDefault=True,
-                        )
-
-                        break
-                    except Exception as e:
-                        if "you must delete an existing version" in str(e):
-                            versions = iam.list_policy_versions(PolicyArn=arn)[
-                                "Versions"
-                            ]
-                            oldest = [v for v in versions if not v["IsDefaultVersion"]][
-                                -1
-                            ]["VersionId"]
-                            iam.delete_policy_version(PolicyArn=arn, VersionId=oldest)
-
-                            continue
-
-                        raise
-
-            iam.attach_role_policy(RoleName=role_name, PolicyArn=arn)
-
-            return role_arn
-        except Exception:
-            logger.exception("Unhandled exception")
-
-            retries -= 1
-            if retries < 1:
+                    continue
+
                 raise
 
-            sleep(choice(range(1, 10)))  # nosec B311
+    iam.attach_role_policy(RoleName=role_name, PolicyArn=arn)
+
+    return role_arn
 
 
 def get_current_version(type_name):
@@ -210,35 +207,27 @@ def register(event, _):
         "ExecutionRoleArn": execution_role_arn,
     }
 
-    retries = 3
-    while True:
-        try:
-            try:
-                response = cfn.register_type(**kwargs)
-            except cfn.exceptions.CFNRegistryException as e:
-                if "Maximum number of versions exceeded" not in str(e):
-                    raise
-
-                delete_oldest(props["TypeName"])
+    version_arn = retry(submit, kwargs, backoff=Backoff(attempts=4, base=15, cap=60))
+    if version_arn:
+        cfn.set_type_default_version(Arn=version_arn)
+        set_version(type_name, props.get("Version", "0.0.0"))
 
-                continue
+    return version_arn
 
-            version_arn = stabilize(response["RegistrationToken"])
 
-            break
-        except Exception as e:
-            if not retries:
+def submit(kwargs):
+    while True:
+        try:
+            response = cfn.register_type(**kwargs)
+        except cfn.exceptions.CFNRegistryException as e:
+            if "Maximum number of versions exceeded" not in str(e):
                 raise
 
-            retries -= 1
-            logger.exception("Failed to stabilize")
+            delete_oldest(kwargs["TypeName"])
 
-            sleep(60)
-    if version_arn:
-        cfn.set_type_default_version(Arn=version_arn)
-        set_version(type_name, props.get("Version", "0.0.0"))
+            continue
 
-    return version_arn
+        return stabilize(response["RegistrationToken"])
 
 
 def delete_oldest(name):
@@ -268,6 +257,7 @@ def delete(event, _):
 def handler(event, context):
     props = event.get("ResourceProperties", {})
     logger.setLevel(props.get("LogLevel", logging.INFO))
+    set_deadline(context)
 
     logger.debug(json.dumps(event))
 